@@ -0,0 +1,317 @@
+"""
+Benchmarks
+
+Run
+    python3 bench.py four_numbers
+
+to compare the Z3 backends of the four numbers solver (part2.py):
+the average time to solve a puzzle with method="single", for each
+backend and each size of the numbers (in bits).
+
+    python3 bench.py collisions
+
+compares the collision checks of part1.py (the original Z3 encoding,
+the linear encoding, and the analytic test) on random pairs of each
+kind of shape.
+
+    python3 bench.py shape_memory
+
+measures the memory used per shape by the slotted shape classes of
+part1.py, by equivalent classes with a __dict__ (as they were before),
+and by shape_arrays.
+
+    python3 bench.py scaling --output results.json
+
+runs each workload of SCALING_WORKLOADS (proving the pigeonhole
+principle, batches of four numbers puzzles, and batches of collision
+checks) for a range of sizes. For every run it records the wall time,
+the peak Python memory, and the Z3 resource count and peak memory,
+and for every workload it fits a power law time = c * size^k.
+With --output the records and fits are written as JSON; with
+--baseline a previous JSON file is read, and any run more than
+--tolerance (by default 25%) slower than in the baseline is reported
+as a regression (and the exit status is 1).
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+import helper
+import part1
+import part2
+import part3
+
+def four_numbers_puzzles(bits, count, rng):
+    """
+    count puzzles with numbers of about the given size: half of them
+    generated from some x and y, the rest random (usually no solution).
+    """
+    puzzles = []
+    half = max(bits // 2, 1)
+    for _ in range(count // 2):
+        y = rng.randint(1, 2 ** half)
+        x = y * rng.randint(1, 2 ** half)
+        puzzles.append((x + y, x - y, x * y, x // y))
+    while len(puzzles) < count:
+        puzzles.append(tuple(rng.randint(0, 2 ** bits) for _ in range(4)))
+    return puzzles
+
+def bench_four_numbers(widths=(4, 8, 16, 24, 32), count=30, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for bits in widths:
+        puzzles = four_numbers_puzzles(bits, count, rng)
+        for backend in ("int", "bv"):
+            # Start from fresh solvers, so that no backend reuses work
+            part2._four_numbers_session.cache_clear()
+            start = time.perf_counter()
+            for puzzle in puzzles:
+                part2.solve_stage1(*puzzle, method="single", backend=backend)
+            elapsed = time.perf_counter() - start
+            rows.append({"bits": bits, "backend": backend, "ms": 1000 * elapsed / count})
+    return rows
+
+def _random_rectangle(rng):
+    while True:
+        shape = part1.random_shape(rng)
+        if isinstance(shape, part1.Rectangle):
+            return shape
+
+def _random_circle(rng):
+    while True:
+        shape = part1.random_shape(rng)
+        if isinstance(shape, part1.Circle):
+            return shape
+
+COLLISION_KINDS = {
+    "rectangle/rectangle": (_random_rectangle, _random_rectangle),
+    "rectangle/circle": (_random_rectangle, _random_circle),
+    "circle/circle": (_random_circle, _random_circle),
+    "polygon/rectangle": (part1.random_polygon, _random_rectangle),
+    "polygon/polygon": (part1.random_polygon, part1.random_polygon),
+}
+
+COLLISION_CHECKS = {
+    "z3": part1.shapes_collide,
+    "z3 linear": part1.shapes_collide_linear,
+    "analytic": part1.shapes_collide_analytic,
+}
+
+def bench_collisions(count=100, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for kind, (make1, make2) in COLLISION_KINDS.items():
+        pairs = [(make1(rng), make2(rng)) for _ in range(count)]
+        for name, check in COLLISION_CHECKS.items():
+            start = time.perf_counter()
+            for s1, s2 in pairs:
+                check(s1, s2)
+            elapsed = time.perf_counter() - start
+            rows.append({"kind": kind, "check": name, "ms": 1000 * elapsed / count})
+    return rows
+
+class _DictRectangle:
+    # Rectangle as it was before it had __slots__
+    def __init__(self, x, y, w, h, vx, vy):
+        self.x = x
+        self.y = y
+        self.vx = vx
+        self.vy = vy
+        self.w = w
+        self.h = h
+
+def _measure(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+def bench_shape_memory(count=100_000):
+    # Floats, so that no store benefits from Python's small int cache
+    fields = [(i + 0.5, i + 0.5, 10.5, 10.5, 1.5, 1.5) for i in range(count)]
+    builds = {
+        "dict": lambda: [_DictRectangle(*f) for f in fields],
+        "slots": lambda: [part1.Rectangle(*f) for f in fields],
+    }
+    if part1.np is not None:
+        shapes = [part1.Rectangle(*f) for f in fields]
+        builds["arrays"] = lambda: part1.shape_arrays(shapes)
+    return [
+        {"store": name, "bytes": _measure(build) / count}
+        for name, build in builds.items()
+    ]
+
+def _pigeonhole(n, rng):
+    return lambda: part3.prove_pigeonhole(n)
+
+def _four_numbers_batch(n, rng):
+    puzzles = four_numbers_puzzles(16, n, rng)
+    def run():
+        # Start from a fresh solver, so that no run reuses earlier work
+        part2._four_numbers_session.cache_clear()
+        for puzzle in puzzles:
+            part2.solve_stage1(*puzzle, method="single")
+    return run
+
+def _collision_batch(n, rng):
+    pairs = [(part1.random_shape(rng), part1.random_shape(rng)) for _ in range(n)]
+    def run():
+        for s1, s2 in pairs:
+            part1.shapes_collide(s1, s2)
+    return run
+
+"""
+Each workload maps a size to a function that runs it once
+(the setup, such as building random inputs, is not timed),
+together with the sizes to run it for.
+"""
+SCALING_WORKLOADS = {
+    "pigeonhole": (_pigeonhole, (100, 300, 1000, 2000, 3000)),
+    "four_numbers": (_four_numbers_batch, (10, 30, 100, 300)),
+    "collisions": (_collision_batch, (10, 30, 100, 300)),
+}
+
+def run_workload(name, n, seed=0):
+    make, _ = SCALING_WORKLOADS[name]
+    run = make(n, random.Random(seed))
+    # The resource count is summed over all checks, memory is the peak
+    statistics = {"rlimit count": 0, "max memory": 0}
+    checks = []
+    def hook(label, result):
+        checks.append(label)
+        result_statistics = result.statistics or {}
+        statistics["rlimit count"] += result_statistics.get("rlimit count", 0)
+        statistics["max memory"] = max(statistics["max memory"], result_statistics.get("max memory", 0))
+    helper.add_hook(hook)
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        helper.remove_hook(hook)
+    return {
+        "workload": name,
+        "n": n,
+        "seconds": seconds,
+        "python_peak_bytes": peak,
+        "checks": len(checks),
+        "z3": statistics,
+    }
+
+def fit_power_law(points):
+    """
+    Least squares fit of log(time) = log(c) + k * log(n) to the
+    (n, time) points; returns (c, k), or None with fewer than two points.
+    """
+    points = [(math.log(n), math.log(t)) for n, t in points if n > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    if sxx == 0:
+        return None
+    k = sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx
+    return math.exp(mean_y - k * mean_x), k
+
+def bench_scaling(workloads=None, seed=0):
+    workloads = list(SCALING_WORKLOADS) if workloads is None else workloads
+    records = []
+    fits = {}
+    for name in workloads:
+        _, sizes = SCALING_WORKLOADS[name]
+        rows = [run_workload(name, n, seed) for n in sizes]
+        records += rows
+        fit = fit_power_law([(row["n"], row["seconds"]) for row in rows])
+        if fit is not None:
+            fits[name] = {"c": fit[0], "k": fit[1]}
+    return {"records": records, "fits": fits}
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Returns the records of results that took more than (1 + tolerance)
+    times as long as the same workload and size in baseline, as
+    (record, baseline seconds) pairs.
+    """
+    previous = {(row["workload"], row["n"]): row["seconds"] for row in baseline["records"]}
+    regressions = []
+    for row in results["records"]:
+        before = previous.get((row["workload"], row["n"]))
+        if before is not None and row["seconds"] > before * (1 + tolerance):
+            regressions.append((row, before))
+    return regressions
+
+def test_fit_power_law():
+    c, k = fit_power_law([(n, 3 * n ** 2) for n in (10, 100, 1000)])
+    assert abs(k - 2) < 1e-9 and abs(c - 3) < 1e-6
+    assert fit_power_law([(10, 1.0)]) is None
+    assert fit_power_law([(10, 1.0), (10, 2.0)]) is None
+
+def test_compare_to_baseline():
+    def record(n, seconds):
+        return {"workload": "pigeonhole", "n": n, "seconds": seconds}
+    baseline = {"records": [record(100, 1.0), record(200, 1.0)]}
+    results = {"records": [record(100, 2.0), record(200, 1.1), record(300, 5.0)]}
+    regressions = compare_to_baseline(results, baseline)
+    assert regressions == [(record(100, 2.0), 1.0)]
+    assert compare_to_baseline(results, baseline, tolerance=1.5) == []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    parser.add_argument("benchmark", choices=["four_numbers", "collisions", "shape_memory", "scaling"])
+    parser.add_argument("--count", type=int, default=30, help="puzzles per size, or pairs per kind of shape")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workload", action="append", choices=list(SCALING_WORKLOADS),
+                        help="scaling workload to run (can be repeated; default all)")
+    parser.add_argument("--output", help="write the scaling results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of earlier scaling results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+    if args.benchmark == "four_numbers":
+        print(f"{'bits':>4}  {'backend':>7}  {'ms/puzzle':>9}")
+        for row in bench_four_numbers(count=args.count, seed=args.seed):
+            print(f"{row['bits']:>4}  {row['backend']:>7}  {row['ms']:>9.2f}")
+    elif args.benchmark == "collisions":
+        print(f"{'shapes':>19}  {'check':>9}  {'ms/pair':>8}")
+        for row in bench_collisions(count=args.count, seed=args.seed):
+            print(f"{row['kind']:>19}  {row['check']:>9}  {row['ms']:>8.3f}")
+    elif args.benchmark == "shape_memory":
+        print(f"{'store':>6}  {'bytes/shape':>11}")
+        for row in bench_shape_memory():
+            print(f"{row['store']:>6}  {row['bytes']:>11.1f}")
+    elif args.benchmark == "scaling":
+        results = bench_scaling(args.workload, seed=args.seed)
+        print(f"{'workload':>12}  {'n':>6}  {'s':>8}  {'peak KiB':>9}  {'checks':>6}  {'rlimit':>10}")
+        for row in results["records"]:
+            print(f"{row['workload']:>12}  {row['n']:>6}  {row['seconds']:>8.3f}  "
+                  f"{row['python_peak_bytes'] / 1024:>9.0f}  {row['checks']:>6}  "
+                  f"{row['z3']['rlimit count']:>10}")
+        for name, fit in results["fits"].items():
+            print(f"{name}: time ~ {fit['c']:.3g} * n^{fit['k']:.2f}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare_to_baseline(results, baseline, args.tolerance)
+            for row, before in regressions:
+                print(f"regression: {row['workload']} n={row['n']}: "
+                      f"{row['seconds']:.3f} s (baseline {before:.3f} s)")
+            if regressions:
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,73 @@ This file provides three functions:
 - get_solution(spec) can be used to get a solution
   to the spec, assuming that it is satisfiable (SAT).
   Otherwise it returns None.
+
+All three functions take an optional session argument.
+A Session keeps a single Z3 solver alive between calls, so that
+background constraints shared by many queries are only asserted once:
+
+    with Session(x > 0, y > 0) as session:
+        for perm in perms:
+            model = get_solution(spec_for(perm), session=session)
+
+To list several solutions, iter_solutions(spec, vars) generates
+distinct models one at a time.
+
+For specs quantified over a size n, prove_bounded(spec, n, bound)
+checks every size up to bound without quantifiers (see unroll).
+
+Results of one-off queries (without a session) can be cached by calling
+enable_cache(); see the documentation of enable_cache below.
+
+Every function also takes optional timeout (in milliseconds) and
+rlimit (a Z3 resource limit) arguments. When a limit is reached the
+result is UNKNOWN. prove and solve return a Result, which compares
+equal to the constants below but also carries solver statistics:
+
+    result = prove(spec, timeout=10_000)
+    if result == UNKNOWN:
+        print(result.time, result.statistics)
+
+Use add_hook(fn) to have fn(label, result) called after every check.
+
+prove, solve, get_solution, and Session also take a strategy:
+the name of a preset in STRATEGIES (tuned for one family of problems),
+or a Z3 tactic name or list of tactic names to apply one after another,
+and solver params:
+    prove(pigeonhole_principle(n, "bounded"), strategy="pigeonhole")
+    solve(spec, strategy=["simplify", "solve-eqs", "smt"])
+
+For hard queries, portfolio_prove(spec) and portfolio_solve(spec) run
+several solver configurations in parallel processes and return the
+first definitive answer.
+To decide many independent specs, solve_many(specs) and
+prove_many(specs) spread them over a pool of processes.
+
+From asyncio code, use prove_async, solve_async, and get_solution_async,
+which do not block the event loop.
+
+To build very large formulas, VarPool reuses numbered variables and
+bulk_and, bulk_or, bulk_sum, and bulk_compare build n-ary terms
+without per-argument overhead.
+
+By default nothing is printed. For interactive use, set
+    helper.VERBOSE = True
+(or pass verbose=True) to print the result and model of each call.
 """
 
+import asyncio
+import concurrent.futures
+import hashlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import shelve
+import time
+import weakref
+from collections import OrderedDict
+from fractions import Fraction
+
 import z3
 
 ## Constants
@@ -25,34 +90,477 @@ UNKNOWN = z3.unknown
 PROVED = UNSAT
 COUNTEREXAMPLE = SAT
 
+# Whether prove and solve print their results (see verbose=...)
+VERBOSE = False
+
 """
-prove(spec)
+Result
+
+The result of a check: SAT, UNSAT, or UNKNOWN, together with
+    result.model       the model found (for SAT), or None
+    result.time        wall time of the check, in seconds
+    result.statistics  a dictionary of Z3 statistics, e.g.
+                       "conflicts", "decisions", "memory", "rlimit count";
+                       counters cover only this check, also when the
+                       solver (a Session) has been used before
+    result.values      a dictionary from variable names to Python values
+                       (int, Fraction, or bool); for results computed in
+                       another process this replaces the model, since
+                       models can not be sent between processes
+    result.text        the model as text
+    result.cached      whether the result came from the cache (see
+                       enable_cache)
+
+values and text are only computed when they are first used, since
+converting a large model can take longer than solving.
 
-Returns PROVED, COUNTEREXAMPLE, or UNKNOWN
+A Result compares equal to the corresponding constant, so
+    prove(spec) == PROVED
+works as before.
 """
-def prove(spec):
-    solver = z3.Solver()
-    solver.add(z3.Not(spec))
-    result = solver.check()
+class Result(z3.CheckSatResult):
+    def __init__(self, r, model=None, time=None, statistics=None, values=None):
+        super().__init__(r)
+        self.model = model
+        self.time = time
+        self.statistics = statistics if statistics is not None else {}
+        self._values = values
+        self.cached = False
+
+    @property
+    def values(self):
+        if self._values is None and self.model is not None:
+            self._values = _model_values(self.model)
+        return self._values
+
+    @property
+    def text(self):
+        if self.model is not None:
+            return str(self.model)
+        if self._values is not None:
+            return str(self._values)
+        return None
+
+"""
+add_hook(fn) / remove_hook(fn)
+
+Registers a function that is called as fn(label, result) after every
+solver check, where label is the name of the entry point ("prove",
+"solve", "get_solution", or "check" for direct session checks)
+and result is the Result. This can be used to collect per-call
+metrics or to log slow queries.
+"""
+_hooks = []
+
+def add_hook(fn):
+    _hooks.append(fn)
+
+def remove_hook(fn):
+    _hooks.remove(fn)
+
+"""
+STRATEGIES
+
+Named solver configurations. Each is a dictionary with the keys
+    "tactic": None for the default solver, the name of a Z3 tactic,
+              or a list of tactic names to apply one after another
+    "params": parameters set on the solver (solver.set), e.g.
+              {"random_seed": 1}; which names are accepted depends
+              on the solver (for example, "smt.mbqi" only exists for
+              the SMT solver)
+and optionally "logic", to use Z3's solver for that logic instead
+(z3.SolverFor). The configurations of portfolio_prove have the same
+form and meaning, so the two are interchangeable:
+
+    "default"      the default solver
+    "pigeonhole"   linear integer problems with bounded variables, like
+                   part3.pigeonhole_principle(n, "bounded"): lia2card
+                   turns the bounded Ints into cardinality constraints,
+                   and skips the solve-eqs preprocessing that the
+                   default solver runs out of memory in for large n
+    "cardinality"  Boolean problems with PbEq/AtMost/AtLeast
+                   constraints, like the "pb" pigeonhole encoding,
+                   using the SAT solver's native cardinality reasoning
+    "nonlinear"    real arithmetic with products, like the collision
+                   constraints of part1 with circles
+    "linear"       linear real arithmetic, like shapes_overlap_linear
+
+Any of them can be passed as strategy=... to prove, solve,
+get_solution, or Session, or used as a portfolio configuration.
+Other names are taken to be Z3 tactics.
+"""
+STRATEGIES = {
+    "default": {"tactic": None, "params": {}},
+    "pigeonhole": {"tactic": ["simplify", "propagate-values", "lia2card", "smt"], "params": {}},
+    "cardinality": {"tactic": None, "logic": "QF_FD", "params": {"sat.cardinality.solver": True}},
+    "nonlinear": {"tactic": ["simplify", "propagate-values", "qfnra-nlsat"], "params": {}},
+    "linear": {"tactic": ["simplify", "propagate-values", "smt"], "params": {}},
+}
+
+# Returns the configuration for a strategy argument, with params added
+def _strategy_config(strategy, params):
+    if strategy is None:
+        config = STRATEGIES["default"]
+    elif isinstance(strategy, dict):
+        config = strategy
+    elif isinstance(strategy, str) and strategy in STRATEGIES:
+        config = STRATEGIES[strategy]
+    else:
+        config = {"tactic": strategy, "params": {}}
+    return dict(config, params={**config.get("params", {}), **(params or {})})
+
+"""
+Session(*background, timeout=None, rlimit=None, ctx=None,
+        strategy=None, params=None)
+
+An incremental solver session.
+
+The background constraints are asserted once, when the session is
+created (more can be added later with session.add).
+Each query is then checked in its own scope (push/pop), so it does
+not affect later queries, while the solver keeps whatever it has
+learned about the background constraints.
+
+Sessions can be used as context managers:
+    with Session(x > 0) as session:
+        session.check(x < 5)
+        session.check(x > 5)
+
+session.check(*constraints) checks the background together with
+the given constraints, and returns a Result (SAT, UNSAT, or UNKNOWN).
+The timeout (milliseconds) and rlimit given when creating the
+session apply to every check, unless overridden in the call.
+session.check_assuming(*literals) does the same using assumption
+literals (Boolean constants) instead of push/pop.
+After a SAT result, session.model() returns the model found.
+ctx is the Z3 context of the solver (by default, the main context).
+strategy and params choose and configure the solver, as for prove.
+"""
+class Session:
+    def __init__(self, *background, timeout=None, rlimit=None, ctx=None,
+                 strategy=None, params=None):
+        self.config = _strategy_config(strategy, params)
+        self.solver = _make_solver(self.config.get("tactic"), self.config.get("logic"), ctx)
+        for name, value in self.config["params"].items():
+            self.solver.set(name, value)
+        self.solver.add(*background)
+        self.timeout = timeout
+        self.rlimit = rlimit
+        self.last_model = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def add(self, *constraints):
+        self.solver.add(*constraints)
+
+    def check(self, *constraints, timeout=None, rlimit=None, label="check"):
+        if not constraints:
+            return self._check((), timeout, rlimit, label)
+        self.solver.push()
+        try:
+            self.solver.add(*constraints)
+            return self._check((), timeout, rlimit, label)
+        finally:
+            self.solver.pop()
+
+    def check_assuming(self, *literals, timeout=None, rlimit=None, label="check"):
+        return self._check(literals, timeout, rlimit, label)
+
+    def _check(self, assumptions, timeout, rlimit, label):
+        timeout = timeout if timeout is not None else self.timeout
+        rlimit = rlimit if rlimit is not None else self.rlimit
+        # Z3 uses 0 to mean "no limit"
+        self.solver.set(timeout=timeout or 0, rlimit=rlimit or 0)
+        before = _statistics(self.solver)
+        start = time.perf_counter()
+        r = self.solver.check(*assumptions)
+        elapsed = time.perf_counter() - start
+        # The model has to be read before the scope is popped
+        model = self.solver.model() if r == SAT else None
+        statistics = _statistics(self.solver, before)
+        result = Result(r.r, model, elapsed, statistics)
+        self.last_model = model
+        for hook in _hooks:
+            hook(label, result)
+        return result
+
+    def model(self):
+        return self.last_model
+
+    def close(self):
+        self.solver = None
+        self.last_model = None
+
+# The statistics of a solver as a dictionary. Z3 keeps running totals
+# (per solver, and for "rlimit count" per context), so with before
+# given, integer counters are made relative to it.
+def _statistics(solver, before=None):
+    stats = solver.statistics()
+    statistics = {key: stats.get_key_value(key) for key in stats.keys()}
+    for key, value in (before or {}).items():
+        if isinstance(value, int) and isinstance(statistics.get(key), int):
+            statistics[key] -= value
+    return statistics
+
+"""
+iter_solutions(spec, vars, limit=None, timeout=None)
+
+Generates distinct solutions to the spec, as Z3 models, one at a time.
+Two solutions are distinct if they differ on at least one of vars
+(a list of Z3 variables).
+
+All solutions are found with a single solver: after each one, a
+"blocking clause" that rules it out is added, so listing k solutions
+takes k + 1 checks.
+Stops after limit solutions (if given), when there are no more,
+or when a check returns UNKNOWN (for example after the timeout,
+in milliseconds, which applies to each check).
+
+Example:
+    x = z3.Int('x')
+    for model in iter_solutions(z3.And(x > 0, x < 4), [x]):
+        print(model[x])
+"""
+def iter_solutions(spec, vars, limit=None, timeout=None):
+    session = Session(spec, timeout=timeout)
+    count = 0
+    while limit is None or count < limit:
+        result = session.check(label="iter_solutions")
+        if result != SAT:
+            return
+        model = result.model
+        yield model
+        count += 1
+        session.add(z3.Or([var != model.eval(var, model_completion=True) for var in vars]))
+
+"""
+unroll(spec, n, k)
+
+Instantiates a spec that is quantified over indices 0 <= i < n
+(like part3.pigeonhole_principle_general) for the concrete size n = k:
+n is replaced by k, and every ForAll (Exists) is replaced by the And
+(Or) of its body for i = 0, ..., k - 1. The result has no quantifiers
+left, so Z3 decides it without quantifier instantiation.
+
+This is only equivalent to the spec for n = k if every quantified
+variable is guarded to lie in [0, n); instances outside of that
+range are dropped.
+"""
+def unroll(spec, n, k):
+    values = [z3.IntVal(j, spec.ctx) for j in range(k)]
+    spec = z3.substitute(spec, (n, z3.IntVal(k, spec.ctx)))
+    return _unroll(spec, values, {})
+
+# memo maps ids to (term, result) pairs: keeping the term alive keeps
+# Z3 from reusing its id for another (temporary) term
+def _unroll(e, values, memo):
+    key = e.get_id()
+    if key in memo:
+        return memo[key][1]
+    if z3.is_quantifier(e) and not e.is_lambda():
+        instances = [
+            _unroll(z3.substitute_vars(e.body(), *combination), values, memo)
+            for combination in itertools.product(values, repeat=e.num_vars())
+        ]
+        result = z3.And(instances, e.ctx) if e.is_forall() else z3.Or(instances, e.ctx)
+    elif z3.is_app(e) and e.num_args() > 0:
+        result = e.decl()(*[_unroll(arg, values, memo) for arg in e.children()])
+    else:
+        result = e
+    memo[key] = (e, result)
+    return result
+
+"""
+prove_bounded(spec, n, bound, timeout=None)
+
+Bounded model checking of a spec quantified over sizes n, as for
+unroll: generates (k, result) for k = 0, ..., bound, where result is
+prove(unroll(spec, n, k)), i.e. PROVED, COUNTEREXAMPLE, or UNKNOWN.
+It stops after the first counterexample, which is a concrete one
+of size k (result.model).
+
+All sizes are checked on one session, each in its own scope.
+PROVED for every k only shows the spec holds up to size bound.
+"""
+def prove_bounded(spec, n, bound, timeout=None):
+    with Session(timeout=timeout) as session:
+        for k in range(bound + 1):
+            result = session.check(z3.Not(unroll(spec, n, k)), label="prove_bounded")
+            yield k, result
+            if result == COUNTEREXAMPLE:
+                return
+
+"""
+enable_cache(maxsize=1024, path=None)
+
+Turns on memoization of prove, solve, and get_solution.
+
+Queries are keyed on a hash of their SMT-LIB text (declarations
+and assertions), so structurally identical formulas share an entry
+even when they were built separately.
+The most recent maxsize results (and their models) are kept in memory.
+
+If path is given, verdicts are also stored in a file at that path
+and survive between runs. Models belong to a Z3 context and are
+not stored on disk, so a SAT result read from disk is only used by
+prove and solve (the result has no model); get_solution solves the
+query again. UNKNOWN is never stored on disk, since it can depend on
+how loaded the machine was when a timeout or rlimit was hit.
+
+A cache hit returns a new Result with cached set, the verdict and
+model of the stored one, time 0, and no statistics (nothing was
+solved). Hooks are called for hits as for any other check.
+
+Setting the environment variable HELPER_CACHE to a path enables the
+persistent cache when this file is imported.
+
+disable_cache() turns the cache off, and cache_info() returns a
+dictionary with the number of hits, misses, and cached entries.
+"""
+class _ResultCache:
+    def __init__(self, maxsize, path):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.store = shelve.open(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, needs_model=False):
+        entry = self.entries.get(key)
+        if entry is None and self.store is not None and key in self.store:
+            entry = (Result(self.store[key]), None)
+            self._remember(key, entry)
+        if entry is not None:
+            result, model = entry
+            if not (needs_model and result == SAT and model is None):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, result, model):
+        self._remember(key, (result, model))
+        if self.store is not None and result != UNKNOWN:
+            self.store[key] = result.r
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+_cache = None
+
+def enable_cache(maxsize=1024, path=None):
+    global _cache
+    disable_cache()
+    _cache = _ResultCache(maxsize, path)
+
+def disable_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+def cache_info():
+    if _cache is None:
+        return {"hits": 0, "misses": 0, "size": 0}
+    return {"hits": _cache.hits, "misses": _cache.misses, "size": len(_cache.entries)}
+
+if os.environ.get("HELPER_CACHE"):
+    enable_cache(path=os.environ["HELPER_CACHE"])
+
+def _cache_key(session, timeout, rlimit):
+    # Limits are part of the key, since they can turn SAT or UNSAT
+    # into UNKNOWN, and so is the strategy
+    text = f"; timeout={timeout} rlimit={rlimit} config={session.config!r}\n"
+    text += session.solver.sexpr()
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# Checks the assertion, either in the given session or as a one-off
+# query (going through the cache, if it is enabled).
+# Returns the Result and the model (or None). With needs_model, a
+# cached SAT result that has no model (read from disk) is not used.
+def _check(assertion, session, timeout, rlimit, label, strategy=None, params=None,
+           needs_model=False):
+    if session is not None:
+        if strategy is not None or params is not None:
+            raise ValueError("the strategy of a session is set when it is created")
+        result = session.check(assertion, timeout=timeout, rlimit=rlimit, label=label)
+        return result, result.model
+    # A one-off query: assert it directly rather than in a scope,
+    # so that Z3 keeps its non-incremental preprocessing
+    session = Session(assertion, timeout=timeout, rlimit=rlimit, strategy=strategy, params=params)
+    if _cache is None:
+        result = session.check(label=label)
+        return result, result.model
+    key = _cache_key(session, timeout, rlimit)
+    entry = _cache.get(key, needs_model)
+    if entry is not None:
+        stored, model = entry
+        # A new Result, so that callers can not change the cached one
+        result = Result(stored.r, model, 0.0, {}, stored._values)
+        result.cached = True
+        for hook in _hooks:
+            hook(label, result)
+        return result, model
+    result = session.check(label=label)
+    _cache.put(key, result, result.model)
+    return result, result.model
+
+"""
+prove(spec, session=None, timeout=None, rlimit=None, verbose=None,
+      strategy=None, params=None)
+
+Returns PROVED, COUNTEREXAMPLE, or UNKNOWN (as a Result)
+With verbose=True (or helper.VERBOSE set), also prints the result
+and any counterexample.
+"""
+def prove(spec, session=None, timeout=None, rlimit=None, verbose=None,
+          strategy=None, params=None):
+    result, _ = _check(z3.Not(spec), session, timeout, rlimit, "prove", strategy, params)
+    _print_prove(result, verbose)
+    return result
+
+def _print_prove(result, verbose):
+    if not (VERBOSE if verbose is None else verbose):
+        return
     if result == PROVED:
         print("proved")
     elif result == COUNTEREXAMPLE:
         print("counterexample")
-        print(solver.model())
+        print(result.text)
     else:
         # result == UNKNOWN
         print("failed to prove or find counterexample")
-    return result
 
 """
-solve(spec)
+solve(spec, session=None, timeout=None, rlimit=None, verbose=None,
+      strategy=None, params=None)
 
-Returns SAT, UNSAT, or UNKNOWN
+Returns SAT, UNSAT, or UNKNOWN (as a Result)
+With verbose=True (or helper.VERBOSE set), also prints the result
+and any solution.
 """
-def solve(spec):
-    solver = z3.Solver()
-    solver.add(spec)
-    result = solver.check()
+def solve(spec, session=None, timeout=None, rlimit=None, verbose=None,
+          strategy=None, params=None):
+    result, _ = _check(spec, session, timeout, rlimit, "solve", strategy, params)
+    _print_solve(result, verbose)
+    return result
+
+def _print_solve(result, verbose):
+    if not (VERBOSE if verbose is None else verbose):
+        return
     if result == UNSAT:
         print("no solution")
     elif result == UNKNOWN:
@@ -60,11 +568,11 @@ def solve(spec):
     else:
         # result == SAT
         print("solution found")
-        print(solver.model())
-    return result
+        print(result.text)
 
 """
-get_solution(spec)
+get_solution(spec, session=None, timeout=None, rlimit=None,
+             strategy=None, params=None)
 
 This function will be useful for Part 2.
 
@@ -79,12 +587,423 @@ Here is an example usage:
     print(model[x])
 
 Returns: either a Z3 model solution or None
+(None also when a timeout or rlimit is reached; use add_hook
+to see the statistics of the check)
 """
-def get_solution(spec):
+def get_solution(spec, session=None, timeout=None, rlimit=None,
+                 strategy=None, params=None):
+    result, model = _check(
+        spec, session, timeout, rlimit, "get_solution", strategy, params, needs_model=True,
+    )
+    if result == SAT:
+        return model
+    else:
+        return None
+
+"""
+portfolio_prove(spec, configs=None, timeout=None, verbose=None)
+portfolio_solve(spec, configs=None, timeout=None, verbose=None)
+
+Like prove and solve, but the query is run under several solver
+configurations at the same time, each in its own process.
+The first definitive answer (SAT or UNSAT) is returned, and the
+other processes are stopped. If every configuration gives up, or the
+timeout (in milliseconds) runs out first, the result is UNKNOWN.
+
+Each configuration is a solver configuration as in STRATEGIES
+(whose entries can be used here too, and which in turn can be given
+as strategy=... to prove and solve). The default is DEFAULT_PORTFOLIO
+below.
+
+The Result has no model; instead result.values holds the values
+of the variables, and result.config is the configuration that won.
+result.errors lists (config, message) for the configurations that
+failed with an error or whose process died (e.g. out of memory);
+they count as UNKNOWN.
+"""
+DEFAULT_PORTFOLIO = [
+    {"tactic": None, "params": {}},
+    {"tactic": None, "params": {"random_seed": 1}},
+    {"tactic": None, "params": {"random_seed": 2}},
+    {"tactic": None, "params": {"smt.arith.solver": 2}},
+    {"tactic": ["simplify", "propagate-values", "solve-eqs", "smt"], "params": {}},
+    {"tactic": None, "params": {"smt.mbqi": False}},
+]
+
+def portfolio_prove(spec, configs=None, timeout=None, verbose=None):
+    result = _portfolio(z3.Not(spec), configs, timeout, "portfolio_prove")
+    _print_prove(result, verbose)
+    return result
+
+def portfolio_solve(spec, configs=None, timeout=None, verbose=None):
+    result = _portfolio(spec, configs, timeout, "portfolio_solve")
+    _print_solve(result, verbose)
+    return result
+
+# Z3 terms can not be pickled, so queries are sent to other processes
+# as SMT-LIB text
+def _to_smt2(assertion):
     solver = z3.Solver()
-    solver.add(spec)
-    result = solver.check()
+    solver.add(assertion)
+    return solver.sexpr()
+
+def _make_solver(tactic, logic=None, ctx=None):
+    if logic is not None:
+        return z3.SolverFor(logic, ctx=ctx)
+    if tactic is None:
+        return z3.Solver(ctx=ctx)
+    if isinstance(tactic, str):
+        return z3.Tactic(tactic, ctx=ctx).solver()
+    return z3.Then(*tactic, ctx=ctx).solver()
+
+def _python_value(value):
+    if z3.is_int_value(value):
+        return value.as_long()
+    if z3.is_rational_value(value):
+        return Fraction(value.numerator_as_long(), value.denominator_as_long())
+    if z3.is_true(value):
+        return True
+    if z3.is_false(value):
+        return False
+    return str(value)
+
+def _model_values(model):
+    return {
+        decl.name(): _python_value(model[decl])
+        for decl in model.decls()
+        if decl.arity() == 0
+    }
+
+# Runs one query in the current process and returns a picklable
+# (r, values, time, statistics) tuple
+def _check_smt2(text, tactic=None, params=None, timeout=None, logic=None):
+    solver = _make_solver(tactic, logic)
+    for name, value in (params or {}).items():
+        solver.set(name, value)
+    solver.from_string(text)
+    if timeout:
+        solver.set(timeout=timeout)
+    before = _statistics(solver)
+    start = time.perf_counter()
+    r = solver.check()
+    elapsed = time.perf_counter() - start
+    values = _model_values(solver.model()) if r == SAT else None
+    statistics = _statistics(solver, before)
+    return r.r, values, elapsed, statistics
+
+def _portfolio_worker(text, config, timeout, conn):
+    try:
+        outcome = _check_smt2(
+            text, config.get("tactic"), config.get("params"), timeout, config.get("logic"),
+        )
+        error = None
+    except Exception as e:
+        # e.g. a tactic that does not apply to this query
+        outcome = (UNKNOWN.r, None, None, {})
+        error = f"{type(e).__name__}: {e}"
+    conn.send(outcome + (error,))
+    conn.close()
+
+def _portfolio(assertion, configs, timeout, label):
+    configs = DEFAULT_PORTFOLIO if configs is None else configs
+    text = _to_smt2(assertion)
+    workers = {}
+    for index, config in enumerate(configs):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(
+            target=_portfolio_worker,
+            args=(text, config, timeout, sender),
+            daemon=True,
+        )
+        worker.start()
+        # Only the worker holds the sending end, so that the receiver
+        # sees the end of the pipe if the worker dies
+        sender.close()
+        workers[index] = (worker, receiver)
+    start = time.perf_counter()
+    result = Result(UNKNOWN.r, time=0.0)
+    result.config = None
+    errors = []
+    pending = dict(workers)
+    try:
+        while pending:
+            remaining = None
+            if timeout is not None:
+                remaining = max(timeout / 1000 - (time.perf_counter() - start), 0)
+            waitables = {}
+            for index, (worker, receiver) in pending.items():
+                waitables[receiver] = index
+                waitables[worker.sentinel] = index
+            ready = multiprocessing.connection.wait(list(waitables), timeout=remaining)
+            if not ready:
+                break
+            for index in {waitables[obj] for obj in ready}:
+                worker, receiver = pending.pop(index)
+                try:
+                    # A worker can exit right after sending its result
+                    if not receiver.poll():
+                        raise EOFError
+                    r, values, elapsed, statistics, error = receiver.recv()
+                except EOFError:
+                    worker.join()
+                    r, error = UNKNOWN.r, f"worker exited with code {worker.exitcode}"
+                if error is not None:
+                    errors.append((configs[index], error))
+                if r != UNKNOWN.r and result.config is None:
+                    result = Result(r, None, elapsed, statistics, values)
+                    result.config = configs[index]
+            if result.config is not None:
+                break
+    finally:
+        for worker, receiver in workers.values():
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+            receiver.close()
+    result.time = time.perf_counter() - start
+    result.errors = errors
+    for hook in _hooks:
+        hook(label, result)
+    return result
+
+"""
+solve_many(specs, processes=None, chunksize=1, ordered=True, timeout=None)
+prove_many(specs, processes=None, chunksize=1, ordered=True, timeout=None)
+
+Decide many independent specs with a pool of worker processes
+(by default, one per CPU). Nothing is printed.
+
+Returns a generator of Results, in the same order as specs.
+With ordered=False, it instead generates (index, result) pairs as
+soon as each spec is decided, where index is the position of the
+spec in specs.
+chunksize is the number of specs sent to a worker at a time;
+larger chunks reduce overhead when there are many small specs.
+timeout (in milliseconds) applies to each spec separately.
+
+As with portfolio_solve, results have no model; result.values holds
+the values of the variables instead.
+
+specs can be a generator: they are converted to SMT-LIB a window of
+chunks at a time, as workers become free, so the first results come
+back before the last specs are built. If a worker process dies (for
+example it is killed, or runs out of memory), this raises
+concurrent.futures.process.BrokenProcessPool rather than waiting for
+it forever.
+"""
+def solve_many(specs, processes=None, chunksize=1, ordered=True, timeout=None):
+    return _check_many(specs, processes, chunksize, ordered, timeout, "solve_many")
+
+def prove_many(specs, processes=None, chunksize=1, ordered=True, timeout=None):
+    assertions = (z3.Not(spec) for spec in specs)
+    return _check_many(assertions, processes, chunksize, ordered, timeout, "prove_many")
+
+def _batch_worker(chunk):
+    return [(index,) + _check_smt2(text, timeout=timeout) for index, text, timeout in chunk]
+
+def _check_many(assertions, processes, chunksize, ordered, timeout, label):
+    processes = processes or os.cpu_count() or 1
+    assertions = enumerate(assertions)
+    # At most window chunks are queued or running at a time. Specs are
+    # converted to text here, when their chunk is submitted: Z3 is not
+    # thread safe, so this can not happen in the executor's threads
+    window = processes * 4
+    executor = concurrent.futures.ProcessPoolExecutor(processes)
+    pending = []
+
+    def submit():
+        chunk = [(index, _to_smt2(assertion), timeout)
+                 for index, assertion in itertools.islice(assertions, chunksize)]
+        if chunk:
+            pending.append(executor.submit(_batch_worker, chunk))
+        return bool(chunk)
+
+    try:
+        while True:
+            while len(pending) < window and submit():
+                pass
+            if not pending:
+                break
+            if ordered:
+                done = [pending.pop(0)]
+            else:
+                finished, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                done = [future for future in pending if future in finished]
+                pending[:] = [future for future in pending if future not in finished]
+            for future in done:
+                # Raises BrokenProcessPool if a worker died
+                for index, r, values, elapsed, statistics in future.result():
+                    result = Result(r, None, elapsed, statistics, values)
+                    for hook in _hooks:
+                        hook(label, result)
+                    yield result if ordered else (index, result)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+"""
+prove_async(spec, timeout=None, rlimit=None, verbose=None)
+solve_async(spec, timeout=None, rlimit=None, verbose=None)
+get_solution_async(spec, timeout=None, rlimit=None)
+
+Coroutine versions of prove, solve, and get_solution, for use with
+asyncio:
+    result = await prove_async(spec)
+
+The check runs in a worker thread, on a copy of the spec in a separate
+Z3 context, so the event loop keeps running in the meantime.
+If the awaiting task is cancelled (for example by asyncio.wait_for),
+the check is interrupted.
+
+At most ASYNC_CONCURRENCY checks run at the same time; further calls
+wait for a free slot. Use set_async_concurrency(n) to change it.
+Hooks registered with add_hook are called from the worker thread.
+"""
+ASYNC_CONCURRENCY = 4
+
+_async_semaphores = weakref.WeakKeyDictionary()
+
+def set_async_concurrency(n):
+    global ASYNC_CONCURRENCY
+    ASYNC_CONCURRENCY = n
+    _async_semaphores.clear()
+
+async def prove_async(spec, timeout=None, rlimit=None, verbose=None):
+    result = await _check_async(z3.Not(spec), timeout, rlimit, "prove")
+    _print_prove(result, verbose)
+    return result
+
+async def solve_async(spec, timeout=None, rlimit=None, verbose=None):
+    result = await _check_async(spec, timeout, rlimit, "solve")
+    _print_solve(result, verbose)
+    return result
+
+async def get_solution_async(spec, timeout=None, rlimit=None):
+    result = await _check_async(spec, timeout, rlimit, "get_solution")
     if result == SAT:
-        return solver.model()
+        return result.model
     else:
         return None
+
+def _async_semaphore(loop):
+    # A semaphore can only be used from one event loop
+    if loop not in _async_semaphores:
+        _async_semaphores[loop] = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    return _async_semaphores[loop]
+
+async def _check_async(assertion, timeout, rlimit, label):
+    loop = asyncio.get_running_loop()
+    async with _async_semaphore(loop):
+        # Z3 contexts are not thread safe: the worker thread only ever
+        # touches its own context, and translating to and from it
+        # happens here, on the event loop thread
+        ctx = z3.Context()
+        session = Session(assertion.translate(ctx), timeout=timeout, rlimit=rlimit, ctx=ctx)
+        future = loop.run_in_executor(None, lambda: session.check(label=label))
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            ctx.interrupt()
+            # Keep the slot until the thread has actually stopped
+            await asyncio.wait([future])
+            raise
+    if result.model is not None:
+        result.model = result.model.translate(z3.main_ctx())
+    return result
+
+"""
+VarPool(ctx=None)
+
+A pool of numbered Z3 variables, for building large formulas quickly.
+pool.ints("h", n) returns [h_0, ..., h_{n-1}], creating them the first
+time and reusing them afterwards (also for any smaller n), so building
+several formulas over the same variables only pays for them once.
+pool.bitvecs(prefix, n, width) and pool.bools(prefix, n) do the same
+for bit-vectors and Booleans.
+
+The bulk_* functions build n-ary terms directly with the low-level
+Z3 API, skipping the type checks and coercions that z3.And, z3.Sum,
+and the Python operators do for every argument:
+
+    holes = pool.ints("h", n)
+    spec = bulk_and(bulk_compare(holes, ">=", 0) + [bulk_sum(holes) == m])
+
+bulk_compare(terms, op, value) compares every term to the same value;
+op is one of COMPARISONS. All terms must have the same sort.
+"""
+class VarPool:
+    def __init__(self, ctx=None):
+        self.ctx = z3.main_ctx() if ctx is None else ctx
+        self._vectors = {}
+
+    def ints(self, prefix, n):
+        return self._vector(prefix, z3.IntSort(self.ctx), z3.ArithRef, n)
+
+    def bitvecs(self, prefix, n, width):
+        return self._vector(prefix, z3.BitVecSort(width, self.ctx), z3.BitVecRef, n)
+
+    def bools(self, prefix, n):
+        return self._vector(prefix, z3.BoolSort(self.ctx), z3.BoolRef, n)
+
+    def clear(self):
+        self._vectors.clear()
+
+    def _vector(self, prefix, sort, ref, n):
+        vector = self._vectors.setdefault((prefix, sort.sexpr()), [])
+        ctx_ref = self.ctx.ref()
+        for i in range(len(vector), n):
+            symbol = z3.to_symbol(f"{prefix}_{i}", self.ctx)
+            ast = z3.Z3_mk_const(ctx_ref, symbol, sort.ast)
+            vector.append(ref(ast, self.ctx))
+        return vector[:n]
+
+COMPARISONS = {
+    "==": z3.Z3_mk_eq,
+    "<=": z3.Z3_mk_le,
+    "<": z3.Z3_mk_lt,
+    ">=": z3.Z3_mk_ge,
+    ">": z3.Z3_mk_gt,
+    "u<=": z3.Z3_mk_bvule,
+    "u<": z3.Z3_mk_bvult,
+    "u>=": z3.Z3_mk_bvuge,
+    "u>": z3.Z3_mk_bvugt,
+}
+
+def _ast_array(terms):
+    array = (z3.Ast * len(terms))()
+    for i, term in enumerate(terms):
+        array[i] = term.as_ast()
+    return array
+
+def bulk_and(terms, ctx=None):
+    if not terms:
+        return z3.BoolVal(True, ctx)
+    ctx = terms[0].ctx
+    return z3.BoolRef(z3.Z3_mk_and(ctx.ref(), len(terms), _ast_array(terms)), ctx)
+
+def bulk_or(terms, ctx=None):
+    if not terms:
+        return z3.BoolVal(False, ctx)
+    ctx = terms[0].ctx
+    return z3.BoolRef(z3.Z3_mk_or(ctx.ref(), len(terms), _ast_array(terms)), ctx)
+
+def bulk_sum(terms):
+    if not terms:
+        raise ValueError("bulk_sum needs at least one term")
+    ctx = terms[0].ctx
+    if z3.is_bv(terms[0]):
+        # Bit-vector addition is binary in the API
+        total = terms[0].as_ast()
+        for term in terms[1:]:
+            total = z3.Z3_mk_bvadd(ctx.ref(), total, term.as_ast())
+        return z3.BitVecRef(total, ctx)
+    return z3.ArithRef(z3.Z3_mk_add(ctx.ref(), len(terms), _ast_array(terms)), ctx)
+
+def bulk_compare(terms, op, value):
+    if not terms:
+        return []
+    ctx = terms[0].ctx
+    compare = COMPARISONS[op]
+    ctx_ref = ctx.ref()
+    value_ast = terms[0].sort().cast(value).as_ast()
+    return [z3.BoolRef(compare(ctx_ref, term.as_ast(), value_ast), ctx) for term in terms]
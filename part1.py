@@ -2,10 +2,19 @@
 Part 1: Mini exercises
 """
 
+import math
+import random
+from fractions import Fraction
+
 import z3
 import pytest
 
-from helper import prove, solve, SAT, UNSAT, PROVED, COUNTEREXAMPLE, UNKNOWN
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from helper import prove, solve, Session, Result, SAT, UNSAT, PROVED, COUNTEREXAMPLE, UNKNOWN
 
 """
 A. Writing specifications
@@ -230,6 +239,9 @@ Generalize your functions in parts 8-11 to work for any shape
 Implement one other shape in this system.
 """
 class Shape:
+    # Slots instead of a __dict__ per shape (see part J)
+    __slots__ = ("x", "y", "vx", "vy")
+
     def __init__(self, x, y, vx, vy):
         self.x = x
         self.y = y
@@ -237,10 +249,28 @@ class Shape:
         self.vy = vy
     def position(self, t):
         return (self.x + self.vx * t, self.y + self.vy * t)
-    def contains(self, px, py):
+    def center(self, t=None):
+        """
+        The center at time t, or at the shape's own (x, y) if t is None.
+        Unlike position(t), this does not create a new shape.
+        """
+        if t is None:
+            return (self.x, self.y)
+        return Shape.position(self, t)
+    def contains(self, px, py, t=None):
         raise NotImplementedError
+    def contains_linear(self, px, py, t=None):
+        """
+        A linear (no multiplication of variables, no If) formula that
+        is true at least whenever contains(px, py) is; see part I.
+        """
+        return self.contains(px, py, t)
 
 class Rectangle(Shape):
+    __slots__ = ("w", "h")
+    # The constructor arguments, in order
+    fields = ("x", "y", "w", "h", "vx", "vy")
+
     def __init__(self, x, y, w, h, vx, vy):
         super().__init__(x, y, vx, vy)
         self.w = w
@@ -248,28 +278,104 @@ class Rectangle(Shape):
     def position(self, t):
         xt, yt = super().position(t)
         return Rectangle(xt, yt, self.w, self.h, self.vx, self.vy)
-    def contains(self, px, py):
-        return z3.And(abs(px - self.x) <= self.w / 2, abs(py - self.y) <= self.h / 2)
+    def contains(self, px, py, t=None):
+        x, y = self.center(t)
+        return z3.And(abs(px - x) <= self.w / 2, abs(py - y) <= self.h / 2)
+    def contains_linear(self, px, py, t=None):
+        # Four half-planes instead of abs, which becomes an If
+        x, y = self.center(t)
+        return z3.And(
+            px - x <= self.w / 2, x - px <= self.w / 2,
+            py - y <= self.h / 2, y - py <= self.h / 2,
+        )
 
 class Circle(Shape):
+    __slots__ = ("r",)
+    fields = ("x", "y", "r", "vx", "vy")
+
     def __init__(self, x, y, r, vx, vy):
         super().__init__(x, y, vx, vy)
         self.r = r
     def position(self, t):
         xt, yt = super().position(t)
         return Circle(xt, yt, self.r, self.vx, self.vy)
-    def contains(self, px, py):
-        return (px - self.x) ** 2 + (py - self.y) ** 2 <= self.r ** 2
+    def contains(self, px, py, t=None):
+        x, y = self.center(t)
+        return (px - x) ** 2 + (py - y) ** 2 <= self.r ** 2
+    def contains_linear(self, px, py, t=None):
+        # A 16-sided polygon around the circle. Each side is a
+        # half-plane a * dx + b * dy <= r * |(a, b)|, with the length
+        # |(a, b)| rounded up so that the polygon is never too small.
+        x, y = self.center(t)
+        return z3.And([
+            a * (px - x) + b * (py - y) <= self.r * bound
+            for a, b, bound in _CIRCLE_SIDES
+        ])
+
+def _circle_sides():
+    sides = []
+    for a, b in ((1, 0), (2, 1), (1, 1), (1, 2)):
+        for _ in range(4):
+            bound = Fraction(math.ceil(math.hypot(a, b) * 10 ** 6), 10 ** 6)
+            sides.append((a, b, bound))
+            a, b = -b, a
+    return sides
+
+_CIRCLE_SIDES = _circle_sides()
+
+class ConvexPolygon(Shape):
+    """
+    A convex polygon, given by its center (x, y) and its vertices
+    relative to the center, in order around the polygon. contains needs
+    them counterclockwise, so numeric vertices given clockwise are
+    reversed.
+    """
+    __slots__ = ("vertices",)
+
+    def __init__(self, x, y, vertices, vx, vy):
+        super().__init__(x, y, vx, vy)
+        self.vertices = list(vertices)
+        if _signed_area(self.vertices) < 0:
+            self.vertices.reverse()
+    def position(self, t):
+        xt, yt = super().position(t)
+        return ConvexPolygon(xt, yt, self.vertices, self.vx, self.vy)
+    def edges(self):
+        n = len(self.vertices)
+        return [(self.vertices[i], self.vertices[(i + 1) % n]) for i in range(n)]
+    def contains(self, px, py, t=None):
+        # Inside means on the left of (or on) every edge
+        x, y = self.center(t)
+        return z3.And([
+            (bx - ax) * (py - y - ay) - (by - ay) * (px - x - ax) >= 0
+            for (ax, ay), (bx, by) in self.edges()
+        ])
 
-def shapes_overlap(s1, s2):
+def _signed_area(vertices):
+    """
+    Twice the signed area of the polygon (positive if counterclockwise),
+    or 0 if the vertices are Z3 terms (as in a CollisionTemplate).
+    """
+    if any(z3.is_expr(c) for vertex in vertices for c in vertex):
+        return 0
+    n = len(vertices)
+    return sum(
+        ax * by - bx * ay
+        for (ax, ay), (bx, by) in ((vertices[i], vertices[(i + 1) % n]) for i in range(n))
+    )
+
+def shapes_overlap(s1, s2, t=None):
+    """
+    With t given, the shapes are taken at time t (without creating the
+    moved shapes with position(t)).
+    """
     px = z3.Real("px")
     py = z3.Real("py")
-    return z3.And(s1.contains(px, py), s2.contains(px, py))
+    return z3.And(s1.contains(px, py, t), s2.contains(px, py, t))
 
 def shapes_collide(s1, s2):
     t = z3.Real("t")
-    s1t, s2t = s1.position(t), s2.position(t)
-    overlap_constr = shapes_overlap(s1t, s2t)
+    overlap_constr = shapes_overlap(s1, s2, t)
     spec = z3.And(t >= 0, overlap_constr)
     return solve(spec) == SAT
 
@@ -282,4 +388,720 @@ def test_shapes_collide():
     c2 = Circle(15, 0, 5, 0, 0)
     assert shapes_collide(c1, c2)
 
-    assert shapes_collide(r1, c2)
\ No newline at end of file
+    assert shapes_collide(r1, c2)
+
+"""
+D. Analytic collision detection
+
+Asking Z3 whether two shapes collide is far too slow for real-time use
+(see Q12). For rectangles and circles the earliest time of contact can
+also be computed directly.
+
+Relative to the first shape, the second one moves in a straight line:
+its center is at d + dv * t. The shapes overlap exactly when that point
+is inside a fixed region around the origin (the Minkowski sum of the
+two shapes): a box for two rectangles, a disk for two circles, and a
+box with rounded corners for a rectangle and a circle. The rounded box
+is the union of two boxes and four disks, and for each of those the
+times when a moving point is inside form a single interval:
+per-axis "slabs" for a box, and the roots of a quadratic for a disk.
+
+time_of_impact(s1, s2) returns the earliest time t >= 0 at which the
+shapes overlap, or None if they never do. Times involving only
+rectangles are exact Fractions; times involving a circle are floats
+(the square root of the discriminant), but whether a collision happens
+at all is always decided exactly.
+
+shapes_collide (with Z3) is kept as the reference: the tests check that
+both agree.
+"""
+
+def _box_entry_time(dx, dy, dvx, dvy, half_w, half_h):
+    """
+    Earliest t >= 0 with |dx + dvx * t| <= half_w and
+    |dy + dvy * t| <= half_h, or None.
+    """
+    lo, hi = Fraction(0), None
+    for d, dv, half in ((dx, dvx, half_w), (dy, dvy, half_h)):
+        if dv == 0:
+            # (abs is the Z3 version defined above)
+            if d > half or d < -half:
+                return None
+            continue
+        t1, t2 = (-half - d) / dv, (half - d) / dv
+        lo = max(lo, min(t1, t2))
+        hi = max(t1, t2) if hi is None else min(hi, max(t1, t2))
+    if hi is not None and lo > hi:
+        return None
+    return lo
+
+def _disk_entry_time(dx, dy, dvx, dvy, radius):
+    """
+    Earliest t >= 0 with (dx + dvx * t)^2 + (dy + dvy * t)^2 <= radius^2,
+    or None.
+    """
+    a = dvx * dvx + dvy * dvy
+    b = 2 * (dx * dvx + dy * dvy)
+    c = dx * dx + dy * dy - radius * radius
+    if c <= 0:
+        return Fraction(0)
+    # Already apart: the distance has to be decreasing, and the closest
+    # approach has to be close enough
+    discriminant = b * b - 4 * a * c
+    if a == 0 or b >= 0 or discriminant < 0:
+        return None
+    return (-b - math.sqrt(discriminant)) / (2 * a)
+
+def _rounded_box_entry_time(dx, dy, dvx, dvy, half_w, half_h, radius):
+    times = [
+        _box_entry_time(dx, dy, dvx, dvy, half_w + radius, half_h),
+        _box_entry_time(dx, dy, dvx, dvy, half_w, half_h + radius),
+    ]
+    for cx in (-half_w, half_w):
+        for cy in (-half_h, half_h):
+            times.append(_disk_entry_time(dx - cx, dy - cy, dvx, dvy, radius))
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+def time_of_impact(s1, s2):
+    """
+    s1, s2: Rectangles or Circles with numeric (not Z3) fields,
+    or ConvexPolygons together with Rectangles or ConvexPolygons (part I)
+
+    returns: the earliest time t >= 0 at which the shapes overlap,
+    or None if they never do.
+    """
+    dx, dy = Fraction(s2.x) - Fraction(s1.x), Fraction(s2.y) - Fraction(s1.y)
+    dvx, dvy = Fraction(s2.vx) - Fraction(s1.vx), Fraction(s2.vy) - Fraction(s1.vy)
+    if isinstance(s1, ConvexPolygon) or isinstance(s2, ConvexPolygon):
+        return _polygon_entry_time(dx, dy, dvx, dvy, _polygon_vertices(s1), _polygon_vertices(s2))
+    if isinstance(s1, Rectangle) and isinstance(s2, Rectangle):
+        half_w = (Fraction(s1.w) + Fraction(s2.w)) / 2
+        half_h = (Fraction(s1.h) + Fraction(s2.h)) / 2
+        return _box_entry_time(dx, dy, dvx, dvy, half_w, half_h)
+    if isinstance(s1, Circle) and isinstance(s2, Circle):
+        return _disk_entry_time(dx, dy, dvx, dvy, Fraction(s1.r) + Fraction(s2.r))
+    if isinstance(s1, Circle) and isinstance(s2, Rectangle):
+        s1, s2 = s2, s1
+        dx, dy, dvx, dvy = -dx, -dy, -dvx, -dvy
+    if isinstance(s1, Rectangle) and isinstance(s2, Circle):
+        half_w, half_h = Fraction(s1.w) / 2, Fraction(s1.h) / 2
+        return _rounded_box_entry_time(dx, dy, dvx, dvy, half_w, half_h, Fraction(s2.r))
+    raise NotImplementedError(f"no analytic collision test for {type(s1).__name__} and {type(s2).__name__}")
+
+def shapes_collide_analytic(s1, s2):
+    return time_of_impact(s1, s2) is not None
+
+def rectangles_collide_analytic(
+    x1, y1, width1, height1, vx1, vy1,
+    x2, y2, width2, height2, vx2, vy2,
+):
+    """
+    Same as rectangles_collide, without Z3.
+    """
+    return shapes_collide_analytic(
+        Rectangle(x1, y1, width1, height1, vx1, vy1),
+        Rectangle(x2, y2, width2, height2, vx2, vy2),
+    )
+
+def random_shape(rng):
+    x, y = rng.randint(-20, 20), rng.randint(-20, 20)
+    vx, vy = rng.randint(-3, 3), rng.randint(-3, 3)
+    if rng.random() < 0.5:
+        return Rectangle(x, y, rng.randint(1, 10), rng.randint(1, 10), vx, vy)
+    return Circle(x, y, rng.randint(1, 5), vx, vy)
+
+def test_time_of_impact():
+    r1 = Rectangle(0, 0, 10, 10, 1, 0)
+    r2 = Rectangle(30, 0, 10, 10, -1, 0)
+    assert time_of_impact(r1, r2) == 10
+    assert time_of_impact(r1, Rectangle(0, 30, 10, 10, -1, 0)) is None
+    c1 = Circle(0, 0, 5, 1, 0)
+    c2 = Circle(20, 0, 5, 0, 0)
+    assert time_of_impact(c1, c2) == 10
+    # Touching at a corner of the rounded box: the circle reaches the
+    # corner (5, 5) of r1 at t = 5
+    c3 = Circle(8, 14, 5, 0, -1)
+    assert time_of_impact(Rectangle(0, 0, 10, 10, 0, 0), c3) == pytest.approx(5)
+    assert time_of_impact(c3, Rectangle(0, 0, 10, 10, 0, 0)) == pytest.approx(5)
+
+def test_analytic_agrees_with_z3():
+    rng = random.Random(0)
+    for _ in range(150):
+        s1, s2 = random_shape(rng), random_shape(rng)
+        assert shapes_collide_analytic(s1, s2) == shapes_collide(s1, s2)
+    assert rectangles_collide_analytic(0, 0, 10, 10, 1, 0, 20, 0, 10, 10, 0, 0)
+    assert not rectangles_collide_analytic(0, 0, 10, 10, -1, 0, 30, 0, 10, 10, 1, 0)
+
+"""
+E. Batch collision detection with NumPy
+
+For many shapes at once, the same computation can be done on whole
+arrays. shape_arrays(shapes) converts a list of Rectangles and Circles
+into a "struct of arrays": a dictionary with one NumPy array per field.
+
+Each shape is treated as a box with half extents (hw, hh) and a
+radius r around it (a rectangle has r = 0, a circle has hw = hh = 0).
+The Minkowski sum of two such shapes is again a rounded box, with
+half extents hw1 + hw2, hh1 + hh2 and radius r1 + r2, so all three
+kinds of pairs use the rounded box computation from part D.
+
+toi_matrix(a, b) returns an array whose (i, j) entry is the earliest
+time of contact of shape i of a and shape j of b (numpy.inf if they
+never collide); collide_matrix(a, b) is the corresponding boolean
+array. With b omitted, the shapes of a are compared with each other,
+and collision_pairs(a) lists the colliding pairs (i, j) with i < j.
+
+The result agrees with shapes_collide for integer inputs; comparisons
+between slab times use a tolerance of 1e-9 to absorb floating point
+rounding, far smaller than the gap between distinct such times.
+
+This part needs NumPy (pip3 install numpy).
+"""
+
+_SLAB_TOLERANCE = 1e-9
+
+def shape_arrays(shapes):
+    if np is None:
+        raise ImportError("batch collision detection needs numpy")
+    fields = {name: [] for name in ("x", "y", "vx", "vy", "hw", "hh", "r")}
+    for shape in shapes:
+        for name in ("x", "y", "vx", "vy"):
+            fields[name].append(getattr(shape, name))
+        if isinstance(shape, Rectangle):
+            fields["hw"].append(shape.w / 2)
+            fields["hh"].append(shape.h / 2)
+            fields["r"].append(0)
+        elif isinstance(shape, Circle):
+            fields["hw"].append(0)
+            fields["hh"].append(0)
+            fields["r"].append(shape.r)
+        else:
+            raise NotImplementedError(f"no batch collision test for {type(shape).__name__}")
+    return {name: np.asarray(values, dtype=float) for name, values in fields.items()}
+
+def _box_entry_times(dx, dy, dvx, dvy, half_w, half_h):
+    lo = np.zeros(np.broadcast(dx, dvx, half_w).shape)
+    hi = np.full(lo.shape, np.inf)
+    inside = np.ones(lo.shape, dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for d, dv, half in ((dx, dvx, half_w), (dy, dvy, half_h)):
+            t1, t2 = (-half - d) / dv, (half - d) / dv
+            moving = dv != 0
+            lo = np.where(moving, np.maximum(lo, np.minimum(t1, t2)), lo)
+            hi = np.where(moving, np.minimum(hi, np.maximum(t1, t2)), hi)
+            inside &= moving | (np.abs(d) <= half)
+    hit = inside & (lo <= hi + _SLAB_TOLERANCE * np.maximum(1, np.abs(hi)))
+    return np.where(hit, lo, np.inf)
+
+def _disk_entry_times(dx, dy, dvx, dvy, radius):
+    a = dvx * dvx + dvy * dvy
+    b = 2 * (dx * dvx + dy * dvy)
+    c = dx * dx + dy * dy - radius * radius
+    discriminant = b * b - 4 * a * c
+    approaching = (a > 0) & (b < 0) & (discriminant >= 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (-b - np.sqrt(np.maximum(discriminant, 0))) / (2 * a)
+    return np.where(c <= 0, 0.0, np.where(approaching, t, np.inf))
+
+def toi_matrix(a, b=None):
+    if b is None:
+        b = a
+    def pair(name):
+        return a[name][:, None], b[name][None, :]
+    (x1, x2), (y1, y2) = pair("x"), pair("y")
+    (vx1, vx2), (vy1, vy2) = pair("vx"), pair("vy")
+    (hw1, hw2), (hh1, hh2), (r1, r2) = pair("hw"), pair("hh"), pair("r")
+    dx, dy, dvx, dvy = x2 - x1, y2 - y1, vx2 - vx1, vy2 - vy1
+    half_w, half_h, radius = hw1 + hw2, hh1 + hh2, r1 + r2
+    times = np.minimum(
+        _box_entry_times(dx, dy, dvx, dvy, half_w + radius, half_h),
+        _box_entry_times(dx, dy, dvx, dvy, half_w, half_h + radius),
+    )
+    for sx in (-1, 1):
+        for sy in (-1, 1):
+            corner = _disk_entry_times(dx - sx * half_w, dy - sy * half_h, dvx, dvy, radius)
+            # A zero radius leaves just the corner point, which is
+            # already covered by the boxes
+            times = np.minimum(times, np.where(radius > 0, corner, np.inf))
+    return times
+
+def collide_matrix(a, b=None):
+    return np.isfinite(toi_matrix(a, b))
+
+def collision_pairs(a):
+    collide = np.triu(collide_matrix(a), k=1)
+    return [tuple(int(i) for i in pair) for pair in np.argwhere(collide)]
+
+def test_batch_collisions():
+    pytest.importorskip("numpy")
+    rng = random.Random(1)
+    shapes = [random_shape(rng) for _ in range(60)]
+    arrays = shape_arrays(shapes)
+    times = toi_matrix(arrays)
+    for i, s1 in enumerate(shapes):
+        for j, s2 in enumerate(shapes):
+            expected = time_of_impact(s1, s2)
+            if expected is None:
+                assert times[i, j] == np.inf
+            else:
+                assert times[i, j] == pytest.approx(float(expected))
+    pairs = collision_pairs(arrays)
+    assert pairs
+    for i, j in pairs[:20]:
+        assert shapes_collide(shapes[i], shapes[j])
+
+"""
+F. Broad phase
+
+Checking every pair of N shapes takes N^2 narrow phase tests, even
+though most pairs are nowhere near each other. Over a time horizon
+[0, T], each shape stays inside its "swept" bounding box: the box
+around its positions at t = 0 and t = T. Two shapes can only collide
+before T if their swept boxes overlap.
+
+candidate_pairs(shapes, horizon) finds the overlapping swept boxes by
+"sweep and prune": the boxes are sorted by their left edge, and while
+sweeping from left to right only the boxes still open (whose right
+edge has not been passed) are compared on y.
+
+find_collisions(shapes, horizon) runs a narrow phase (by default
+collision_time, see part G) on the candidate pairs only, and returns
+the list of (i, j, t) such that shapes i and j first touch at time
+t <= horizon.
+"""
+
+def swept_bounds(shape, horizon):
+    """
+    returns: (x_min, x_max, y_min, y_max) of the shape over [0, horizon]
+    """
+    # Extent of the shape around its center
+    if isinstance(shape, Rectangle):
+        left, right = -shape.w / 2, shape.w / 2
+        bottom, top = -shape.h / 2, shape.h / 2
+    elif isinstance(shape, Circle):
+        left, right, bottom, top = -shape.r, shape.r, -shape.r, shape.r
+    elif isinstance(shape, ConvexPolygon):
+        left = min(vx for vx, _ in shape.vertices)
+        right = max(vx for vx, _ in shape.vertices)
+        bottom = min(vy for _, vy in shape.vertices)
+        top = max(vy for _, vy in shape.vertices)
+    else:
+        raise NotImplementedError(f"no bounds for {type(shape).__name__}")
+    x_end, y_end = shape.x + shape.vx * horizon, shape.y + shape.vy * horizon
+    return (
+        min(shape.x, x_end) + left, max(shape.x, x_end) + right,
+        min(shape.y, y_end) + bottom, max(shape.y, y_end) + top,
+    )
+
+def candidate_pairs(shapes, horizon):
+    bounds = [swept_bounds(shape, horizon) for shape in shapes]
+    order = sorted(range(len(shapes)), key=lambda i: bounds[i][0])
+    active = []
+    for i in order:
+        x_min, _, y_min, y_max = bounds[i]
+        active = [j for j in active if bounds[j][1] >= x_min]
+        for j in active:
+            if bounds[j][2] <= y_max and y_min <= bounds[j][3]:
+                yield (min(i, j), max(i, j))
+        active.append(i)
+
+def find_collisions(shapes, horizon, narrow_phase=None):
+    """
+    narrow_phase(s1, s2) should return the earliest time of contact,
+    or None.
+    """
+    if narrow_phase is None:
+        narrow_phase = collision_time
+    collisions = []
+    for i, j in candidate_pairs(shapes, horizon):
+        t = narrow_phase(shapes[i], shapes[j])
+        if t is not None and t <= horizon:
+            collisions.append((i, j, t))
+    return sorted(collisions)
+
+def test_find_collisions():
+    rng = random.Random(2)
+    shapes = [random_shape(rng) for _ in range(80)]
+    for shape in shapes:
+        shape.x, shape.y = shape.x * 10, shape.y * 10
+    horizon = 10
+    expected = []
+    for i in range(len(shapes)):
+        for j in range(i + 1, len(shapes)):
+            t = time_of_impact(shapes[i], shapes[j])
+            if t is not None and t <= horizon:
+                expected.append((i, j, t))
+    assert expected
+    assert find_collisions(shapes, horizon) == expected
+    assert len(list(candidate_pairs(shapes, horizon))) < len(shapes) * (len(shapes) - 1) // 2
+
+"""
+G. Earliest collision time with Z3
+
+shapes_collide only says whether two shapes collide; the time is in
+the model, but it is just *some* time of overlap, not the first one.
+earliest_collision_time(s1, s2) asks Z3 for the minimal t >= 0.
+
+When the formula is linear (no circles), z3.Optimize minimizes t
+exactly. Circles make the formula nonlinear, which z3.Optimize does
+not handle reliably, so instead the time is found by bisection on
+a single solver session: each step checks whether the shapes can
+overlap at some t <= mid. The result is then an upper bound on the
+earliest time, within the given tolerance.
+
+The result is a Fraction, or None if the shapes never collide.
+
+collision_time(s1, s2) uses the exact time_of_impact where it can,
+and earliest_collision_time for the pairs that time_of_impact has no
+formula for (a circle and a polygon).
+
+If Z3 can not decide whether the shapes collide at all, this raises
+RuntimeError. If it gives up during the bisection, the result is the
+smallest time of overlap found so far, which is still an upper bound
+on the earliest time, but may be off by more than the tolerance.
+"""
+
+def _real_value(value):
+    if z3.is_algebraic_value(value):
+        value = value.approx(20)
+    return Fraction(value.numerator_as_long(), value.denominator_as_long())
+
+def earliest_collision_time(s1, s2, tolerance=Fraction(1, 10 ** 6)):
+    t = z3.Real("t")
+    spec = z3.And(t >= 0, shapes_overlap(s1, s2, t))
+    if not any(isinstance(s, Circle) for s in (s1, s2)):
+        optimizer = z3.Optimize()
+        optimizer.add(spec)
+        optimizer.minimize(t)
+        result = optimizer.check()
+        if result == SAT:
+            return _real_value(optimizer.model()[t])
+        if result == UNSAT:
+            return None
+    with Session(spec) as session:
+        result = session.check()
+        if result == UNSAT:
+            return None
+        if result == UNKNOWN:
+            raise RuntimeError("Z3 could not decide whether the shapes collide")
+        lo, hi = Fraction(0), _real_value(result.model.eval(t))
+        if session.check(t <= 0) == SAT:
+            return Fraction(0)
+        while hi - lo > tolerance:
+            mid = (lo + hi) / 2
+            result = session.check(t <= z3.RealVal(mid))
+            if result == SAT:
+                hi = min(mid, _real_value(result.model.eval(t)))
+            elif result == UNSAT:
+                lo = mid
+            else:
+                break
+        return hi
+
+def collision_time(s1, s2):
+    try:
+        return time_of_impact(s1, s2)
+    except NotImplementedError:
+        return earliest_collision_time(s1, s2)
+
+def test_earliest_collision_time():
+    r1 = Rectangle(0, 0, 10, 10, 1, 0)
+    r2 = Rectangle(30, 0, 10, 10, -1, 0)
+    assert earliest_collision_time(r1, r2) == 10
+    assert earliest_collision_time(r1, Rectangle(0, 30, 10, 10, -1, 0)) is None
+    rng = random.Random(3)
+    for _ in range(30):
+        s1, s2 = random_shape(rng), random_shape(rng)
+        expected = time_of_impact(s1, s2)
+        t = earliest_collision_time(s1, s2)
+        if expected is None:
+            assert t is None
+        else:
+            assert t == pytest.approx(float(expected), abs=1e-5)
+
+def test_earliest_collision_time_unknown(monkeypatch):
+    c1, c2 = Circle(0, 0, 5, 1, 0), Circle(30, 0, 5, -1, 0)
+    check = Session.check
+    calls = []
+    def flaky_check(session, *constraints, **kwargs):
+        calls.append(constraints)
+        if len(calls) > limit:
+            return Result(UNKNOWN.r)
+        return check(session, *constraints, **kwargs)
+    monkeypatch.setattr(Session, "check", flaky_check)
+    limit = 0
+    with pytest.raises(RuntimeError):
+        earliest_collision_time(c1, c2)
+    # Giving up during the bisection still gives an upper bound
+    limit, calls = 3, []
+    t = earliest_collision_time(c1, c2)
+    assert t >= 10 and t - 10 > Fraction(1, 10 ** 6)
+    assert len(calls) == 4
+
+"""
+H. Collision templates
+
+shapes_collide builds a new formula for every pair of shapes, even
+though all Rectangle/Circle pairs (say) give the same formula up to
+the numbers in it. A CollisionTemplate builds the formula once per
+pair of shape types, with a Z3 variable for every field of both
+shapes. Checking a concrete pair then only substitutes the numbers
+into the template.
+
+(Binding the parameters with equalities on one persistent solver was
+also tried, but with symbolic velocities the template is nonlinear
+(vx * t), and that was about ten times slower than substituting and
+solving the resulting linear formula.)
+
+shapes_collide_compiled(s1, s2) keeps one template per pair of types.
+
+Templates are built for kinds of shapes: a kind is the shape's type,
+except for a ConvexPolygon (section I), where it is
+(ConvexPolygon, number of vertices), and the vertices are variables
+of the template as well.
+"""
+
+def shape_kind(shape):
+    if isinstance(shape, ConvexPolygon):
+        return (ConvexPolygon, len(shape.vertices))
+    return type(shape)
+
+def _template_shape(kind, prefix):
+    """
+    returns: a shape of the given kind with a Z3 variable for every
+    number in it, and the list of those variables
+    """
+    if isinstance(kind, tuple):
+        _, n = kind
+        x, y, vx, vy = (z3.Real(f"{prefix}_{field}") for field in ("x", "y", "vx", "vy"))
+        vertices = [(z3.Real(f"{prefix}_v{i}_x"), z3.Real(f"{prefix}_v{i}_y")) for i in range(n)]
+        params = [x, y, vx, vy] + [c for vertex in vertices for c in vertex]
+        return ConvexPolygon(x, y, vertices, vx, vy), params
+    params = [z3.Real(f"{prefix}_{field}") for field in kind.fields]
+    return kind(*params), params
+
+def _template_values(shape):
+    if isinstance(shape, ConvexPolygon):
+        coords = [c for vertex in shape.vertices for c in vertex]
+        return [shape.x, shape.y, shape.vx, shape.vy] + coords
+    return [getattr(shape, field) for field in type(shape).fields]
+
+class CollisionTemplate:
+    def __init__(self, kind1, kind2):
+        s1, self.params1 = _template_shape(kind1, "s1")
+        s2, self.params2 = _template_shape(kind2, "s2")
+        t = z3.Real("t")
+        self.spec = z3.And(t >= 0, shapes_overlap(s1, s2, t))
+
+    def instantiate(self, s1, s2):
+        bindings = [
+            (param, z3.RealVal(value))
+            for params, shape in ((self.params1, s1), (self.params2, s2))
+            for param, value in zip(params, _template_values(shape))
+        ]
+        return z3.substitute(self.spec, *bindings)
+
+    def collide(self, s1, s2):
+        return solve(self.instantiate(s1, s2)) == SAT
+
+_templates = {}
+
+def shapes_collide_compiled(s1, s2):
+    key = (shape_kind(s1), shape_kind(s2))
+    if key not in _templates:
+        _templates[key] = CollisionTemplate(*key)
+    return _templates[key].collide(s1, s2)
+
+def test_shapes_collide_compiled():
+    _templates.clear()
+    rng = random.Random(4)
+    for _ in range(100):
+        s1, s2 = random_shape(rng), random_shape(rng)
+        assert shapes_collide_compiled(s1, s2) == shapes_collide_analytic(s1, s2)
+    assert len(_templates) == 4
+
+"""
+I. Linear encodings and convex polygons
+
+Circle.contains uses squares of expressions that depend on t, so Z3
+has to use nonlinear real arithmetic, and the abs in
+Rectangle.contains becomes an If (a case split).
+Each shape also has a contains_linear method with a linear encoding:
+four half-planes for a rectangle, and a 16-sided polygon around a
+circle (an over-approximation).
+
+shapes_collide_linear(s1, s2) first checks the linear encoding.
+If even the over-approximation never overlaps, the shapes never
+collide. Otherwise, if the encoding was exact (no circles), they do;
+only when there is a circle is the exact (nonlinear) check needed.
+
+ConvexPolygon is a new shape. Its contains is already linear.
+For the analytic test, time_of_impact uses the separating axis
+theorem: two convex polygons overlap exactly when their projections
+onto every edge normal (of either polygon) overlap. Along each
+normal the projections overlap during one interval of time, like the
+slabs of part D, and the polygons collide during the intersection
+of these intervals. Rectangles are handled as polygons here.
+
+To compare solver times, run
+    python3 bench.py collisions
+"""
+
+def shapes_overlap_linear(s1, s2, t=None):
+    px = z3.Real("px")
+    py = z3.Real("py")
+    return z3.And(s1.contains_linear(px, py, t), s2.contains_linear(px, py, t))
+
+def shapes_collide_linear(s1, s2):
+    t = z3.Real("t")
+    if solve(z3.And(t >= 0, shapes_overlap_linear(s1, s2, t))) == UNSAT:
+        return False
+    if not any(isinstance(s, Circle) for s in (s1, s2)):
+        return True
+    return shapes_collide(s1, s2)
+
+def _polygon_vertices(shape):
+    if isinstance(shape, ConvexPolygon):
+        return [(Fraction(vx), Fraction(vy)) for vx, vy in shape.vertices]
+    if isinstance(shape, Rectangle):
+        half_w, half_h = Fraction(shape.w) / 2, Fraction(shape.h) / 2
+        return [(-half_w, -half_h), (half_w, -half_h), (half_w, half_h), (-half_w, half_h)]
+    raise NotImplementedError(f"no analytic collision test for {type(shape).__name__} and a polygon")
+
+def _polygon_entry_time(dx, dy, dvx, dvy, vertices1, vertices2):
+    """
+    Earliest t >= 0 at which the polygons overlap, where the second
+    polygon's center is at (dx + dvx * t, dy + dvy * t) relative to the
+    first, or None.
+    """
+    lo, hi = Fraction(0), None
+    for vertices in (vertices1, vertices2):
+        n = len(vertices)
+        for i in range(n):
+            (ax, ay), (bx, by) = vertices[i], vertices[(i + 1) % n]
+            nx, ny = by - ay, ax - bx
+            proj1 = [nx * vx + ny * vy for vx, vy in vertices1]
+            proj2 = [nx * vx + ny * vy for vx, vy in vertices2]
+            # The projections overlap when lower <= offset <= upper
+            lower, upper = min(proj1) - max(proj2), max(proj1) - min(proj2)
+            offset, speed = nx * dx + ny * dy, nx * dvx + ny * dvy
+            if speed == 0:
+                if offset < lower or offset > upper:
+                    return None
+                continue
+            t1, t2 = (lower - offset) / speed, (upper - offset) / speed
+            lo = max(lo, min(t1, t2))
+            hi = max(t1, t2) if hi is None else min(hi, max(t1, t2))
+    if hi is not None and lo > hi:
+        return None
+    return lo
+
+_POLYGONS = [
+    [(0, -3), (3, 2), (-3, 2)],
+    [(0, -4), (4, 0), (0, 4), (-4, 0)],
+    [(2, -3), (4, 0), (2, 3), (-2, 3), (-4, 0), (-2, -3)],
+]
+
+def random_polygon(rng):
+    x, y = rng.randint(-20, 20), rng.randint(-20, 20)
+    vx, vy = rng.randint(-3, 3), rng.randint(-3, 3)
+    return ConvexPolygon(x, y, rng.choice(_POLYGONS), vx, vy)
+
+def test_shapes_collide_linear():
+    rng = random.Random(5)
+    for _ in range(100):
+        s1, s2 = random_shape(rng), random_shape(rng)
+        assert shapes_collide_linear(s1, s2) == shapes_collide_analytic(s1, s2)
+
+def test_collision_strategies():
+    rng = random.Random(7)
+    t = z3.Real("t")
+    for _ in range(30):
+        s1, s2 = random_shape(rng), random_shape(rng)
+        spec = z3.And(t >= 0, shapes_overlap(s1, s2, t))
+        assert solve(spec, strategy="nonlinear") == solve(spec)
+        spec = z3.And(t >= 0, shapes_overlap_linear(s1, s2, t))
+        assert solve(spec, strategy="linear") == solve(spec)
+
+def _random_box(rng):
+    return Rectangle(
+        rng.randint(-20, 20), rng.randint(-20, 20), rng.randint(1, 10), rng.randint(1, 10),
+        rng.randint(-3, 3), rng.randint(-3, 3),
+    )
+
+def test_convex_polygon():
+    triangle = ConvexPolygon(0, 0, _POLYGONS[0], 1, 0)
+    assert shapes_collide(triangle, Rectangle(10, 0, 2, 2, 0, 0))
+    assert not shapes_collide(triangle, Rectangle(10, 10, 2, 2, 0, 0))
+    assert time_of_impact(triangle, Rectangle(10, 0, 2, 2, 0, 0)) == Fraction(33, 5)
+    # Clockwise vertices describe the same polygon
+    clockwise = ConvexPolygon(0, 0, [(0, -3), (-3, 2), (3, 2)], 0, 0)
+    assert clockwise.vertices == [(3, 2), (-3, 2), (0, -3)]
+    assert shapes_collide(clockwise, Rectangle(0, 0, 2, 2, 0, 0))
+    rng = random.Random(6)
+    for _ in range(100):
+        s1 = random_polygon(rng)
+        s2 = random_polygon(rng) if rng.random() < 0.5 else _random_box(rng)
+        expected = shapes_collide(s1, s2)
+        assert shapes_collide_analytic(s1, s2) == expected
+        assert shapes_collide_linear(s1, s2) == expected
+        assert shapes_collide_compiled(s1, s2) == expected
+
+def test_polygon_broad_phase():
+    triangle = ConvexPolygon(0, 0, _POLYGONS[0], 1, 0)
+    assert swept_bounds(triangle, 2) == (-3, 5, -3, 2)
+    rng = random.Random(8)
+    shapes = [random_polygon(rng) if i % 2 else _random_box(rng) for i in range(60)]
+    for shape in shapes:
+        shape.x, shape.y = shape.x * 5, shape.y * 5
+    horizon = 10
+    expected = []
+    for i in range(len(shapes)):
+        for j in range(i + 1, len(shapes)):
+            t = time_of_impact(shapes[i], shapes[j])
+            if t is not None and t <= horizon:
+                expected.append((i, j, t))
+    assert expected
+    assert find_collisions(shapes, horizon) == expected
+    # Circles and polygons together: circle/polygon pairs fall back to
+    # earliest_collision_time
+    shapes = [random_polygon(rng) if i % 2 else random_shape(rng) for i in range(16)]
+    for shape in shapes:
+        shape.x, shape.y = shape.x * 2, shape.y * 2
+    expected = []
+    for i in range(len(shapes)):
+        for j in range(i + 1, len(shapes)):
+            t = collision_time(shapes[i], shapes[j])
+            if t is not None and t <= horizon:
+                expected.append((i, j, t))
+    assert any(
+        isinstance(shapes[i], Circle) and isinstance(shapes[j], ConvexPolygon)
+        or isinstance(shapes[i], ConvexPolygon) and isinstance(shapes[j], Circle)
+        for i, j, _ in expected
+    )
+    collisions = find_collisions(shapes, horizon)
+    assert [(i, j) for i, j, _ in collisions] == [(i, j) for i, j, _ in expected]
+    for (_, _, t), (_, _, u) in zip(collisions, expected):
+        assert t == pytest.approx(u, abs=1e-5)
+
+"""
+J. Compact shapes
+
+Shapes use __slots__, so they do not each carry a __dict__, and the
+collision formulas use center(t) / contains(px, py, t) instead of
+creating a moved copy of every shape with position(t).
+For very large numbers of shapes, shape_arrays (part E) stores them
+as one NumPy array per field instead.
+
+To compare memory use with dict-based shapes, run
+    python3 bench.py shape_memory
+"""
+
+def test_compact_shapes():
+    r = Rectangle(0, 0, 10, 10, 1, 0)
+    assert not hasattr(r, "__dict__")
+    t = z3.Real("t")
+    # The formulas are the same with or without position(t)
+    moved = shapes_overlap(r.position(t), Circle(20, 0, 5, 0, 0).position(t))
+    assert moved.eq(shapes_overlap(r, Circle(20, 0, 5, 0, 0), t))
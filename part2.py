@@ -93,23 +93,279 @@ to see if it works!
 
 If you like, you can also write unit tests, but this
 is not required for this part.
+
+=== Batch mode ===
+
+To solve many puzzles at once, run
+    python3 part2.py --batch puzzles.csv > results.jsonl
+
+The input (a file, or - for stdin) has one puzzle per line, either as
+CSV (a,b,c,d) or as JSON Lines ([a, b, c, d] or {"a": ..., "d": ...});
+the format is guessed from the file extension, or given with --format.
+Each output line is a JSON object with the input and the stage 1 and
+stage 2 solutions (or, for a line that is not a puzzle, the line and
+an "error"). Puzzles are read and written as a stream, so memory
+use does not grow with the size of the input. Use --workers N to
+solve with N processes.
+
+=== Lookup index ===
+
+For puzzles with small numbers, all answers can be precomputed:
+    python3 part2.py --build-index puzzles.idx --bound 100000
+writes every solution with x <= 100000 to a sorted file, and
+    python3 part2.py --index puzzles.idx --batch puzzles.csv
+(or use_index("puzzles.idx") from Python) answers both stages by
+binary search in the memory-mapped file before trying anything else.
 """
 
+import argparse
+import csv
+import io
+import json
+import mmap
+import multiprocessing
+import struct
+import sys
 import z3
 import pytest
 
-from helper import solve, get_solution, SAT, UNSAT, UNKNOWN
-from itertools import permutations
+from helper import solve, get_solution, Session, SAT, UNSAT, UNKNOWN
+from functools import lru_cache
+from itertools import combinations_with_replacement, islice, permutations
 
 def get_input():
-    a = input("a: ")
-    b = input("b: ")
-    c = input("c: ")
-    d = input("d: ")
+    a = int(input("a: "))
+    b = int(input("b: "))
+    c = int(input("c: "))
+    d = int(input("d: "))
     return a, b, c, d
 
-def solve_stage1(a, b, c, d):
+# Widest bit-vectors that backend="auto" will use.
+# On this encoding the int backend was faster at every width measured
+# by `python3 bench.py four_numbers` (Z3 solves the sum and difference
+# equations directly), so bit-vectors are never chosen automatically;
+# raise this if the benchmark shows them winning on your Z3 version.
+BV_MAX_WIDTH = 0
+
+def choose_backend(a, b, c, d):
+    """
+    "bv" if the numbers are nonnegative integers that fit in
+    BV_MAX_WIDTH bits, and "int" otherwise.
+    """
+    numbers = [a, b, c, d]
+    if all(_fits_bv(n) for n in numbers) and _bv_width(numbers) <= BV_MAX_WIDTH:
+        return "bv"
+    return "int"
+
+def _fits_bv(n):
+    return isinstance(n, int) and not isinstance(n, bool) and n >= 0
+
+def _bv_width(numbers):
+    # x and y are at most x + y, which is one of the numbers
+    return max(max(numbers).bit_length(), 1)
+
+def four_numbers_vars(a, b, c, d, backend="int"):
+    """
+    The variables x, y, and q (the quotient) used by four_numbers_spec.
+    Raises ValueError for backend="bv" if a number is not a nonnegative
+    integer, since it would wrap around to a large unsigned value.
+    """
+    if backend == "bv":
+        for n in (a, b, c, d):
+            if not _fits_bv(n):
+                raise ValueError(f"backend='bv' needs nonnegative integers, got {n!r}")
+        width = _bv_width([a, b, c, d])
+        return z3.BitVec('x', width), z3.BitVec('y', width), z3.BitVec('q', width)
+    return z3.Int('x'), z3.Int('y'), z3.Int('q')
+
+def four_numbers_spec(a, b, c, d, backend="int"):
+    """
+    A single formula saying that {a, b, c, d} are the sum, difference,
+    product, and quotient of x and y, in some order.
+
+    Repeated numbers give repeated orders (0, 1, 1, 2 has only 12
+    distinct orders, not 24), so each distinct order appears only once.
+
+    backend="int" uses Z3 integers, which makes x * y and q * y
+    nonlinear integer arithmetic.
+    backend="bv" uses unsigned bit-vectors just wide enough for the
+    numbers (which must be nonnegative integers), with guards so that
+    no operation overflows; Z3 can then bit-blast the formula.
+    """
+    x, y, quot_val = four_numbers_vars(a, b, c, d, backend)
+    if backend == "bv":
+        pos_constr = z3.And(x != 0, y != 0)
+        div_constr = z3.And(
+            z3.URem(x, y) == 0,
+            quot_val == z3.UDiv(x, y),
+            # Guards against wrapping around
+            z3.UGE(x, y),
+            z3.BVAddNoOverflow(x, y, False),
+            z3.BVMulNoOverflow(x, y, False),
+        )
+    else:
+        pos_constr = z3.And(x > 0, y > 0)
+        div_constr = z3.And(x == quot_val * y, quot_val > 0)
+    orders = sorted(set(permutations([a, b, c, d])))
+    order_constr = z3.Or([
+        z3.And(x + y == s, x - y == diff, x * y == prod, quot_val == quot)
+        for s, diff, prod, quot in orders
+    ])
+    return z3.And(pos_constr, div_constr, order_constr)
+
+def four_numbers_candidates(a, b, c, d):
+    """
+    All solutions (x, y), found without Z3, or None if the numbers
+    are not all Python integers.
+
+    Two of the numbers must be the sum x + y and the difference x - y,
+    which determine x and y, so it is enough to try the 12 ordered
+    pairs of the numbers and check each candidate directly.
+    """
+    numbers = sorted([a, b, c, d])
+    if not all(isinstance(n, int) for n in numbers):
+        return None
+    solutions = set()
+    for sum_val, diff_val in permutations(numbers, 2):
+        if (sum_val + diff_val) % 2 != 0:
+            continue
+        x, y = (sum_val + diff_val) // 2, (sum_val - diff_val) // 2
+        if x <= 0 or y <= 0 or x % y != 0:
+            continue
+        if sorted([x + y, x - y, x * y, x // y]) == numbers:
+            solutions.add((x, y))
+    return sorted(solutions)
+
+def _z3_confirms(a, b, c, d, solution):
     x, y = z3.Int('x'), z3.Int('y')
+    spec = four_numbers_spec(a, b, c, d)
+    if solution is None:
+        return get_solution(spec) is None
+    x_, y_ = solution
+    return get_solution(z3.And(spec, x == x_, y == y_)) is not None
+
+# Index file layout: a header (magic, bound, number of records),
+# then records (four sorted numbers, x, y), sorted by the numbers
+_INDEX_MAGIC = b"FOURNUM1"
+_INDEX_HEADER = struct.Struct("<8sqq")
+_INDEX_RECORD = struct.Struct("<6q")
+
+def build_index(path, bound):
+    """
+    Writes an index of every solution (x, y) with x <= bound to path.
+    """
+    records = []
+    for y in range(1, bound + 1):
+        for x in range(y, bound + 1, y):
+            key = sorted([x + y, x - y, x * y, x // y])
+            records.append((*key, x, y))
+    records.sort()
+    with open(path, "wb") as f:
+        f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, bound, len(records)))
+        for record in records:
+            f.write(_INDEX_RECORD.pack(*record))
+
+class FourNumbersIndex:
+    """
+    A memory-mapped index written by build_index.
+
+    lookup(a, b, c, d) returns the list of all solutions, in O(log n)
+    time, or None if the index does not cover the puzzle.
+    Every solution of a puzzle satisfies x <= x + y <= max(a, b, c, d),
+    so an index with bound >= max(a, b, c, d) contains all of them.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.bound, self.count = _INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != _INDEX_MAGIC:
+            raise ValueError(f"{path} is not a four numbers index")
+
+    def _record(self, i):
+        return _INDEX_RECORD.unpack_from(self.data, _INDEX_HEADER.size + i * _INDEX_RECORD.size)
+
+    def lookup(self, a, b, c, d):
+        numbers = sorted([a, b, c, d])
+        if not all(isinstance(n, int) for n in numbers) or numbers[-1] > self.bound:
+            return None
+        key = tuple(numbers)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[:4] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        solutions = []
+        while lo < self.count:
+            record = self._record(lo)
+            if record[:4] != key:
+                break
+            solutions.append(record[4:])
+            lo += 1
+        return solutions
+
+    def close(self):
+        self.data.close()
+
+_index = None
+
+def use_index(path):
+    """
+    Makes solve_stage1 and solve_stage2 (with method="auto") consult the
+    index at path first. use_index(None) stops using it.
+    """
+    global _index
+    if _index is not None:
+        _index.close()
+    _index = FourNumbersIndex(path) if path is not None else None
+
+def _solutions_without_z3(a, b, c, d, method):
+    if method == "auto" and _index is not None:
+        solutions = _index.lookup(a, b, c, d)
+        if solutions is not None:
+            return solutions
+    return four_numbers_candidates(a, b, c, d)
+
+@lru_cache(maxsize=128)
+def _four_numbers_session(a, b, c, d, backend):
+    # Keyed on the sorted numbers, so that stage 1 and stage 2 of the
+    # same puzzle share one solver
+    return Session(four_numbers_spec(a, b, c, d, backend))
+
+def solve_stage1(a, b, c, d, method="auto", verify=False, backend="auto"):
+    """
+    method="auto" (the default) uses the index (see use_index) if it
+    covers the puzzle, then four_numbers_candidates when the numbers
+    are integers, and Z3 otherwise.
+    method="fast" only uses four_numbers_candidates.
+    method="single" solves one formula covering every order of the
+    numbers; method="permutations" tries the 24 orders one at a time.
+
+    With verify=True, an answer found without Z3 is checked with Z3.
+    backend selects the encoding used by method="single" (see
+    four_numbers_spec); "auto" uses choose_backend.
+    """
+    if method in ("auto", "fast"):
+        solutions = _solutions_without_z3(a, b, c, d, method)
+        if solutions is not None or method == "fast":
+            solution = solutions[0] if solutions else None
+            if verify and not _z3_confirms(a, b, c, d, solution):
+                raise AssertionError(f"Z3 disagrees with {solution} for {a, b, c, d}")
+            return solution
+        method = "single"
+
+    if method == "single":
+        if backend == "auto":
+            backend = choose_backend(a, b, c, d)
+        x, y, _ = four_numbers_vars(a, b, c, d, backend)
+        model = _four_numbers_session(*sorted([a, b, c, d]), backend).check().model
+        if model:
+            return (model[x].as_long(), model[y].as_long())
+        return None
+
+    x, y = z3.Int('x'), z3.Int('y')
+
     pos_constr = z3.And(x > 0, y > 0)
     sum_val = x + y
     diff_val = x - y
@@ -117,11 +373,13 @@ def solve_stage1(a, b, c, d):
     quot_val = z3.Int('q')
     div_constr = z3.And(x == quot_val * y, quot_val > 0)
 
-    for perm in permutations([a, b, c, d]):
-        spec = z3.And(pos_constr, sum_val == perm[0], diff_val == perm[1], prod_val == perm[2], quot_val == perm[3], div_constr)
-        model = get_solution(spec)
-        if model:
-            return (model[x], model[y])
+    # The constraints shared by all 24 orders are asserted once
+    with Session(pos_constr, div_constr) as session:
+        for perm in permutations([a, b, c, d]):
+            spec = z3.And(sum_val == perm[0], diff_val == perm[1], prod_val == perm[2], quot_val == perm[3])
+            model = get_solution(spec, session=session)
+            if model:
+                return (model[x].as_long(), model[y].as_long())
 
 def run_interactive():
     print("=== Input ===")
@@ -141,22 +399,268 @@ def run_interactive():
     else:
         print("No solutions")
 
-def solve_stage2(a, b, c, d, prev_sol):
+def solve_stage2(a, b, c, d, prev_sol, method="auto", backend="auto"):
+    """
+    Returns a solution other than prev_sol, or None.
+    method and backend are as for solve_stage1.
+    """
     x_, y_ = prev_sol
+    if method in ("auto", "fast"):
+        solutions = _solutions_without_z3(a, b, c, d, method)
+        if solutions is not None or method == "fast":
+            others = [sol for sol in solutions or [] if sol != (x_, y_)]
+            return others[0] if others else None
+        method = "single"
+
+    if method == "single":
+        if backend == "auto":
+            backend = choose_backend(a, b, c, d)
+        x, y, _ = four_numbers_vars(a, b, c, d, backend)
+        # Reuses the solver from stage 1
+        session = _four_numbers_session(*sorted([a, b, c, d]), backend)
+        model = get_solution(z3.Or(x != x_, y != y_), session=session)
+        if model:
+            return (model[x].as_long(), model[y].as_long())
+        return None
+
     x, y = z3.Int('x'), z3.Int('y')
+    unique_constr = z3.Or(x != x_, y != y_)
+
     pos_constr = z3.And(x > 0, y > 0)
     sum_val = x + y
     diff_val = x - y
     prod_val = x * y
     quot_val = z3.Int('q')
     div_constr = z3.And(x == quot_val * y, quot_val > 0)
-    unique_constr = z3.Or(x != x_, y != y_)
 
-    for perm in permutations([a, b, c, d]):
-        spec = z3.And(pos_constr, unique_constr, sum_val == perm[0], diff_val == perm[1], prod_val == perm[2], quot_val == perm[3], div_constr)
-        model = get_solution(spec)
-        if model:
-            return (model[x], model[y])
+    with Session(pos_constr, unique_constr, div_constr) as session:
+        for perm in permutations([a, b, c, d]):
+            spec = z3.And(sum_val == perm[0], diff_val == perm[1], prod_val == perm[2], quot_val == perm[3])
+            model = get_solution(spec, session=session)
+            if model:
+                return (model[x].as_long(), model[y].as_long())
+
+class PuzzleError(ValueError):
+    """
+    A line of input that is not a puzzle: text is the line, and
+    message says what is wrong with it.
+    """
+    def __init__(self, text, message):
+        super().__init__(text, message)
+        self.text = text
+        self.message = message
+
+def _parse_number(n):
+    # Numbers must already be integers: 1.5, true, or "1" are errors
+    if isinstance(n, bool) or not isinstance(n, (int, float)) or (
+        isinstance(n, float) and not n.is_integer()
+    ):
+        raise ValueError(f"not an integer: {json.dumps(n)}")
+    return int(n)
+
+def _parse_puzzle(puzzle):
+    if isinstance(puzzle, dict):
+        missing = [key for key in "abcd" if key not in puzzle]
+        if missing:
+            raise ValueError(f"missing {', '.join(missing)}")
+        puzzle = [puzzle[key] for key in "abcd"]
+    if not isinstance(puzzle, list) or len(puzzle) != 4:
+        raise ValueError("expected four numbers")
+    return tuple(_parse_number(n) for n in puzzle)
+
+def read_puzzles(stream, format="csv"):
+    """
+    Generates the puzzles in stream (an open text file) as tuples
+    (a, b, c, d). Blank lines are skipped.
+    A line that is not a puzzle is generated as a PuzzleError instead
+    of being raised, so that one bad line does not stop a long stream.
+    """
+    if format == "csv":
+        for line in stream:
+            if line.strip():
+                try:
+                    row = next(csv.reader([line]))
+                    yield _parse_puzzle([int(field) for field in row])
+                except ValueError as e:
+                    yield PuzzleError(line.rstrip("\r\n"), str(e))
+    elif format == "jsonl":
+        for line in stream:
+            if line.strip():
+                try:
+                    yield _parse_puzzle(json.loads(line))
+                except ValueError as e:
+                    yield PuzzleError(line.rstrip("\r\n"), str(e))
+    else:
+        raise ValueError(f"unknown puzzle format: {format}")
+
+def solve_puzzle(puzzle, method="auto"):
+    """
+    Solves stages 1 and 2 of one puzzle, and returns the result as a
+    dictionary that can be written as JSON.
+    For a PuzzleError (from read_puzzles), the dictionary has the input
+    line and the error instead.
+    """
+    if isinstance(puzzle, PuzzleError):
+        return {"input": puzzle.text, "error": puzzle.message}
+    stage1 = solve_stage1(*puzzle, method=method)
+    stage2 = solve_stage2(*puzzle, stage1, method=method) if stage1 else None
+    return {
+        "input": list(puzzle),
+        "stage1": list(stage1) if stage1 else None,
+        "stage2": list(stage2) if stage2 else None,
+    }
+
+def _solve_puzzle_task(task):
+    return solve_puzzle(*task)
+
+def run_batch(infile, outfile, format="csv", workers=1, chunksize=256, method="auto"):
+    """
+    Solves every puzzle in infile and writes one JSON line per puzzle to
+    outfile, in the same order.
+
+    With workers > 1, puzzles are solved by a pool of processes.
+    Only a bounded window of puzzles is in flight at a time, so memory
+    use does not depend on the number of puzzles.
+    """
+    tasks = ((puzzle, method) for puzzle in read_puzzles(infile, format))
+    if workers <= 1:
+        results = map(_solve_puzzle_task, tasks)
+        for result in results:
+            outfile.write(json.dumps(result) + "\n")
+        return
+    window = workers * chunksize * 4
+    with multiprocessing.Pool(workers) as pool:
+        while True:
+            batch = list(islice(tasks, window))
+            if not batch:
+                break
+            for result in pool.imap(_solve_puzzle_task, batch, chunksize):
+                outfile.write(json.dumps(result) + "\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Four numbers game solver")
+    parser.add_argument("--batch", metavar="FILE", help="solve the puzzles in FILE (- for stdin)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="input format (default: from the file extension)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=256, help="puzzles sent to a worker at a time")
+    parser.add_argument("--method", default="auto", choices=["auto", "fast", "single", "permutations"])
+    parser.add_argument("--index", metavar="PATH", help="consult the lookup index at PATH")
+    parser.add_argument("--build-index", metavar="PATH", help="write a lookup index to PATH and exit")
+    parser.add_argument("--bound", type=int, default=10_000, help="largest x in the index built by --build-index")
+    args = parser.parse_args(argv)
+    if args.build_index is not None:
+        build_index(args.build_index, args.bound)
+        return
+    if args.index is not None:
+        use_index(args.index)
+    if args.batch is None:
+        run_interactive()
+        return
+    format = args.format
+    if format is None:
+        format = "jsonl" if args.batch.endswith((".jsonl", ".json")) else "csv"
+    if args.batch == "-":
+        run_batch(sys.stdin, sys.stdout, format, args.workers, args.chunksize, args.method)
+    else:
+        with open(args.batch, newline="") as infile:
+            run_batch(infile, sys.stdout, format, args.workers, args.chunksize, args.method)
+
+def test_solve_stage1():
+    assert solve_stage1(20, 95, 105, 500) == (100, 5)
+    assert solve_stage1(2, 6, 18, 72) == (12, 6)
+    assert solve_stage1(0, 1, 1, 2) == (1, 1)
+    assert solve_stage1(1, 2, 3, 4) is None
+
+def test_solve_stage2():
+    assert solve_stage2(20, 95, 105, 500, (100, 5)) is None
+    assert solve_stage2(0, 1, 1, 2, (1, 1)) is None
+
+def test_solve_methods_agree():
+    puzzles = [(20, 95, 105, 500), (2, 6, 18, 72), (0, 1, 1, 2), (1, 2, 3, 4), (4, 0, 4, 1)]
+    for puzzle in puzzles:
+        fast = solve_stage1(*puzzle, verify=True)
+        assert fast == solve_stage1(*puzzle, method="single", backend="int")
+        assert fast == solve_stage1(*puzzle, method="single", backend="bv")
+        assert fast == solve_stage1(*puzzle, method="permutations")
+        if fast:
+            stage2 = solve_stage2(*puzzle, fast)
+            assert stage2 == solve_stage2(*puzzle, fast, method="single", backend="int")
+            assert stage2 == solve_stage2(*puzzle, fast, method="single", backend="bv")
+            assert stage2 == solve_stage2(*puzzle, fast, method="permutations")
+
+def test_bv_backend_no_overflow():
+    # With numbers below 8 the bit-vectors have only 3 bits, so any
+    # missing overflow guard would produce wrong solutions
+    for puzzle in combinations_with_replacement(range(8), 4):
+        expected = four_numbers_candidates(*puzzle)
+        solution = solve_stage1(*puzzle, method="single", backend="bv")
+        assert solution == (expected[0] if expected else None)
+    with pytest.raises(ValueError):
+        solve_stage1(-3, -3, -2, 4, method="single", backend="bv")
+    assert solve_stage1(-3, -3, -2, 4, method="single", backend="int") is None
+    assert choose_backend(-1, 3, 2, 1) == "int"
+    assert choose_backend(2 ** 40, 3, 2, 1) == "int"
+
+def test_four_numbers_candidates():
+    # Every puzzle generated from small x, y is solved
+    for x in range(1, 30):
+        for y in range(1, x + 1):
+            if x % y == 0:
+                assert (x, y) in four_numbers_candidates(x + y, x - y, x * y, x // y)
+    assert four_numbers_candidates(1, 2, 3, 4) == []
+    assert four_numbers_candidates("1", "2", "3", "4") is None
+
+def test_run_batch():
+    puzzles = "20,95,105,500\n\n1,2,3,4\n"
+    out = io.StringIO()
+    run_batch(io.StringIO(puzzles), out)
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+        {"input": [20, 95, 105, 500], "stage1": [100, 5], "stage2": None},
+        {"input": [1, 2, 3, 4], "stage1": None, "stage2": None},
+    ]
+    # Bad lines give an error record, and the rest is still solved
+    puzzles = "20,95,x,500\n1,2,3\n1,2,3,4\n"
+    out = io.StringIO()
+    run_batch(io.StringIO(puzzles), out, workers=2, chunksize=1)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [record["input"] for record in records] == ["20,95,x,500", "1,2,3", [1, 2, 3, 4]]
+    assert "error" in records[0] and "error" in records[1]
+    assert records[2]["stage1"] is None
+    out = io.StringIO()
+    lines = '[1, 2]\n{"a": 1}\nnot json\n[1.5, 2, 3, 4]\n[true, 1, 1, 2]\n[2, 6, 18, 72.0]\n'
+    run_batch(io.StringIO(lines), out, format="jsonl")
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert ["error" in record for record in records] == [True] * 5 + [False]
+    assert records[1]["error"] == "missing b, c, d"
+    assert records[3] == {"input": "[1.5, 2, 3, 4]", "error": "not an integer: 1.5"}
+    puzzles = '[2, 6, 18, 72]\n{"a": 0, "b": 1, "c": 1, "d": 2}\n'
+    out_parallel = io.StringIO()
+    run_batch(io.StringIO(puzzles), out_parallel, format="jsonl", workers=2, chunksize=1)
+    assert [json.loads(line)["stage1"] for line in out_parallel.getvalue().splitlines()] == [[12, 6], [1, 1]]
+
+def test_index(tmp_path):
+    path = str(tmp_path / "puzzles.idx")
+    build_index(path, 200)
+    index = FourNumbersIndex(path)
+    try:
+        for x in range(1, 201):
+            for y in range(1, x + 1):
+                if x % y == 0:
+                    puzzle = (x + y, x - y, x * y, x // y)
+                    if max(puzzle) <= 200:
+                        assert index.lookup(*puzzle) == four_numbers_candidates(*puzzle)
+                    else:
+                        assert index.lookup(*puzzle) is None
+        assert index.lookup(1, 2, 3, 4) == []
+        assert index.lookup(20, 95, 105, 500) is None
+    finally:
+        index.close()
+    use_index(path)
+    try:
+        assert solve_stage1(2, 6, 18, 72) == (12, 6)
+        assert solve_stage2(2, 6, 18, 72, (12, 6)) is None
+    finally:
+        use_index(None)
 
 if __name__ == "__main__":
-    run_interactive()
+    main()
@@ -32,10 +32,21 @@ The second encoding is for a general number of pigeons and holes.
 These will be examples of limitations (1) and (2) above.
 """
 
+import asyncio
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
 import z3
 import pytest
 
-from helper import prove, solve, SAT, UNSAT, PROVED, COUNTEREXAMPLE, UNKNOWN
+import helper
+from helper import prove, solve, get_solution, Session, SAT, UNSAT, PROVED, COUNTEREXAMPLE, UNKNOWN
+from helper import enable_cache, disable_cache, cache_info, add_hook, remove_hook
+from helper import STRATEGIES, DEFAULT_PORTFOLIO
+from helper import portfolio_prove, prove_many, prove_async, iter_solutions
+from helper import VarPool, bulk_and, bulk_or, bulk_sum, bulk_compare
+from helper import prove_bounded, unroll
 
 """
 === First encoding ===
@@ -64,21 +75,76 @@ There are test cases that will help check that
 your implementation is correct.
 """
 
-def pigeons_in_holes(m, n):
+"""
+=== Alternative encodings ===
+
+pigeons_in_holes, two_in_hole and pigeonhole_principle take an
+optional encoding, one of ENCODINGS:
+
+- "int": one unbounded Int per hole (the original encoding).
+- "bounded": as "int", but every hole also has the upper bound m.
+- "bv": one bit-vector per hole, wide enough that the sum of n
+    holes of at most m pigeons can not overflow.
+- "pb": one Bool p_i_j per pigeon i and hole j, with a pseudo-Boolean
+    constraint that every pigeon is in exactly one hole and a
+    cardinality constraint (z3.AtLeast) for two pigeons in a hole.
+
+All encodings describe the same property, but only "int" and
+"bounded" name the holes h_i, so only they have hole counts in a model.
+"pb" needs m * n variables and is only practical for small n.
+"""
+
+ENCODINGS = ("int", "bounded", "bv", "pb")
+
+# The holes are taken from a shared pool, so pigeons_in_holes and
+# two_in_hole (and repeated calls for the same n) reuse the same
+# variables instead of creating them again
+_pool = VarPool()
+
+def _holes(m, n, encoding):
+    if encoding == "bv":
+        width = max(m * n, 1).bit_length()
+        return _pool.bitvecs("h", n, width)
+    if encoding == "pb":
+        return [_pool.bools(f"p_{i}", n) for i in range(m)]
+    if encoding in ("int", "bounded"):
+        return _pool.ints("h", n)
+    raise ValueError(f"unknown encoding: {encoding!r}")
+
+def _one_hole_each(pigeons):
+    return [z3.PbEq([(p, 1) for p in pigeon], 1) for pigeon in pigeons]
+
+def pigeons_in_holes(m, n, encoding="int"):
     if n == 0:
         return m == 0
-    holes = [z3.Int(f"h_{i}") for i in range(n)]
-    nonnegative_constr = [hole >= 0 for hole in holes]
-    sum_constr = z3.Sum(holes) == m
-    return z3.And(nonnegative_constr + [sum_constr])
-
-def two_in_hole(m, n):
+    holes = _holes(m, n, encoding)
+    if encoding == "pb":
+        return bulk_and(_one_hole_each(holes))
+    if encoding == "bv":
+        bound_constr = bulk_compare(holes, "u<=", m)
+        return bulk_and(bound_constr + [bulk_sum(holes) == m])
+    nonnegative_constr = bulk_compare(holes, ">=", 0)
+    if encoding == "bounded":
+        nonnegative_constr += bulk_compare(holes, "<=", m)
+    sum_constr = bulk_sum(holes) == m
+    return bulk_and(nonnegative_constr + [sum_constr])
+
+def two_in_hole(m, n, encoding="int"):
     if n == 0:
         return False
-    holes = [z3.Int(f"h_{i}") for i in range(n)]
-    two_constr = [hole >= 2 for hole in holes]
-    sum_constr = z3.Sum(holes) == m
-    return z3.And(z3.Or(two_constr), sum_constr)
+    holes = _holes(m, n, encoding)
+    if encoding == "pb":
+        columns = [[pigeon[j] for pigeon in holes] for j in range(n)]
+        two_constr = [z3.AtLeast(*column, 2) for column in columns]
+        return bulk_and([bulk_or(two_constr)] + _one_hole_each(holes))
+    sum_constr = bulk_sum(holes) == m
+    if encoding == "bv":
+        # Without the bounds the sum could wrap around
+        two_constr = bulk_compare(holes, "u>=", 2)
+        bound_constr = bulk_compare(holes, "u<=", m)
+        return bulk_and([bulk_or(two_constr), sum_constr] + bound_constr)
+    two_constr = bulk_compare(holes, ">=", 2)
+    return bulk_and([bulk_or(two_constr), sum_constr])
 
 """
 Test cases
@@ -92,6 +158,20 @@ def test_pigeons_in_holes():
     assert solve(pigeons_in_holes(1, 0)) == UNSAT
     assert prove(pigeons_in_holes(1, 1)) == COUNTEREXAMPLE
 
+def test_pigeons_in_holes_values(capsys):
+    result = solve(pigeons_in_holes(4, 3))
+    assert capsys.readouterr().out == ""
+    assert sum(result.values.values()) == 4
+    solve(pigeons_in_holes(4, 3), verbose=True)
+    assert capsys.readouterr().out.startswith("solution found")
+
+def test_pigeons_in_holes_all_solutions():
+    holes = [z3.Int("h_0"), z3.Int("h_1")]
+    models = iter_solutions(pigeons_in_holes(2, 2), holes)
+    solutions = {tuple(model[hole].as_long() for hole in holes) for model in models}
+    assert solutions == {(0, 2), (1, 1), (2, 0)}
+    assert len(list(iter_solutions(pigeons_in_holes(2, 2), holes, limit=2))) == 2
+
 def test_two_in_hole():
     assert solve(two_in_hole(3, 3)) == SAT
     assert prove(two_in_hole(1, 1)) == COUNTEREXAMPLE
@@ -115,8 +195,27 @@ a specification (as a Z3 formula) that says that the
 pigeonhole principle is true for n + 1 pigeons and n holes.
 """
 
-def pigeonhole_principle(n):
-    return z3.Implies(pigeons_in_holes(n + 1, n), two_in_hole(n + 1, n))
+def pigeonhole_principle(n, encoding="int"):
+    return z3.Implies(
+        pigeons_in_holes(n + 1, n, encoding),
+        two_in_hole(n + 1, n, encoding),
+    )
+
+"""
+prove_pigeonhole(n, encoding="int", prover=prove, **kwargs)
+
+Builds pigeonhole_principle(n, encoding) and proves it with
+prover(spec, **kwargs). The returned Result has the time taken to
+build the formula as result.build_time, separately from the solving
+time in result.time.
+"""
+def prove_pigeonhole(n, encoding="int", prover=prove, **kwargs):
+    start = time.perf_counter()
+    spec = pigeonhole_principle(n, encoding)
+    build_time = time.perf_counter() - start
+    result = prover(spec, **kwargs)
+    result.build_time = build_time
+    return result
 
 """
 Let's test the performance of Z3 on your implementation.
@@ -156,12 +255,101 @@ def test_pigeonhole_principle_medium():
     assert prove(pigeonhole_principle(2000)) == PROVED
     assert prove(pigeonhole_principle(3000)) == PROVED
 
+def test_pigeonhole_principle_encodings():
+    for encoding in ENCODINGS:
+        assert solve(pigeons_in_holes(4, 3, encoding)) == SAT
+        assert solve(pigeons_in_holes(1, 0, encoding)) == UNSAT
+        assert prove(two_in_hole(1, 1, encoding)) == COUNTEREXAMPLE
+        assert solve(z3.And([
+            pigeons_in_holes(1, 2, encoding),
+            two_in_hole(1, 2, encoding),
+        ])) == UNSAT
+        for n in range(1, 6):
+            assert prove(pigeonhole_principle(n, encoding)) == PROVED
+    with pytest.raises(ValueError):
+        pigeonhole_principle(3, "float")
+
+def test_pigeonhole_principle_pool():
+    # Both halves of the spec share one vector of holes
+    spec = pigeonhole_principle(5)
+    assert len(z3.z3util.get_vars(spec)) == 5
+    assert pigeons_in_holes(6, 3).eq(pigeons_in_holes(6, 3))
+    result = prove_pigeonhole(10)
+    assert result == PROVED
+    assert result.build_time >= 0
+
+def test_pigeonhole_principle_cache(tmp_path):
+    path = str(tmp_path / "cache")
+    enable_cache(path=path)
+    try:
+        assert prove(pigeonhole_principle(100)) == PROVED
+        assert prove(pigeonhole_principle(100)) == PROVED
+        assert cache_info()["hits"] == 1
+        # A fresh in-memory cache is refilled from disk
+        enable_cache(path=path)
+        assert prove(pigeonhole_principle(100)) == PROVED
+        assert cache_info() == {"hits": 1, "misses": 0, "size": 1}
+    finally:
+        disable_cache()
+
+def test_cache_hits():
+    enable_cache()
+    calls = []
+    hook = lambda label, result: calls.append((label, result.cached))
+    add_hook(hook)
+    try:
+        first = prove_pigeonhole(20)
+        second = prove(pigeonhole_principle(20))
+        # A hit is a new Result, without the build_time set on the first
+        assert second == PROVED and second.cached and not first.cached
+        assert not hasattr(second, "build_time")
+        assert second.time == 0 and second.statistics == {}
+        assert calls == [("prove", False), ("prove", True)]
+    finally:
+        remove_hook(hook)
+        disable_cache()
+
+def test_pigeonhole_principle_many():
+    specs = [pigeonhole_principle(n) for n in range(1, 11)]
+    assert list(prove_many(specs, chunksize=2)) == [PROVED] * 10
+    pairs = list(prove_many(specs, ordered=False))
+    assert sorted(index for index, _ in pairs) == list(range(10))
+    assert all(result == PROVED for _, result in pairs)
+    # Specs are built as they are needed
+    built = []
+    def specs():
+        for n in range(1, 101):
+            built.append(n)
+            yield pigeonhole_principle(n)
+    results = prove_many(specs(), processes=1)
+    assert next(results) == PROVED
+    assert len(built) < 100
+    results.close()
+
+def test_prove_many_dead_worker(monkeypatch):
+    # The worker processes are forked, so they see the patched function
+    monkeypatch.setattr(helper, "_check_smt2", lambda text, timeout=None: os._exit(1))
+    with pytest.raises(BrokenProcessPool):
+        list(prove_many([pigeonhole_principle(n) for n in range(1, 5)], processes=2))
+
 @pytest.mark.skip
 def test_pigeonhole_principle_large():
     assert prove(pigeonhole_principle(10_000)) == PROVED
     assert prove(pigeonhole_principle(20_000)) == PROVED
     assert prove(pigeonhole_principle(30_000)) == PROVED
 
+"""
+The large test runs out of memory in the preprocessing that the default
+solver does for linear integer arithmetic, whatever the encoding.
+The "pigeonhole" strategy skips it, and turns the bounded holes into
+cardinality constraints, which proves n = 30,000 in about a second.
+"""
+
+def test_pigeonhole_principle_large_bounded():
+    for n in [10_000, 20_000, 30_000]:
+        result = prove_pigeonhole(n, "bounded", strategy="pigeonhole")
+        assert result == PROVED
+
 """
 === Second encoding ===
 
@@ -229,6 +417,30 @@ Describe what happened below.
 def test_pigeonhole_principle_general():
     assert prove(pigeonhole_principle_general()) == UNKNOWN
 
+def test_pigeonhole_principle_general_timeout():
+    calls = []
+    def hook(label, result):
+        calls.append((label, result))
+    add_hook(hook)
+    try:
+        result = prove(pigeonhole_principle_general(), timeout=1000)
+    finally:
+        remove_hook(hook)
+    assert result == UNKNOWN
+    assert result.time < 10
+    assert "rlimit count" in result.statistics
+    assert calls == [("prove", result)]
+
+def test_pigeonhole_principle_general_async():
+    async def run():
+        start = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(prove_async(pigeonhole_principle_general()), 0.5)
+        # The cancelled check was interrupted and did not block the loop
+        assert time.perf_counter() - start < 10
+        assert await prove_async(pigeonhole_principle(10)) == PROVED
+    asyncio.run(run())
+
 """
 Just to be sure we haven't made a mistake,
 we can also try to run a version
@@ -275,6 +487,110 @@ def pigeonhole_principle_false():
 def test_pigeonhole_principle_false():
     assert prove(pigeonhole_principle_false()) == COUNTEREXAMPLE
 
+def test_pigeonhole_portfolio():
+    assert portfolio_prove(pigeonhole_principle(10)) == PROVED
+    result = portfolio_prove(pigeonhole_principle_false(), timeout=60_000)
+    assert result == COUNTEREXAMPLE
+    assert result.config is not None
+    assert result.values["n"] >= 0
+
+def test_portfolio_worker_failures(monkeypatch):
+    configs = [{"tactic": "no-such-tactic"}, {"tactic": None}]
+    result = portfolio_prove(pigeonhole_principle(10), configs)
+    assert result == PROVED
+    assert [config for config, _ in result.errors] == configs[:1]
+    # Workers that die without an answer count as UNKNOWN
+    monkeypatch.setattr(helper, "_check_smt2", lambda *args: os._exit(1))
+    result = portfolio_prove(pigeonhole_principle(10), configs)
+    assert result == UNKNOWN
+    assert len(result.errors) == 2
+
+# These run after the general tests: how long Z3 takes to give up on
+# pigeonhole_principle_general depends on what else is in the context
+def test_statistics_per_check():
+    first = prove(pigeonhole_principle(8)).statistics["rlimit count"]
+    assert prove(pigeonhole_principle(8)).statistics["rlimit count"] == first
+    x = z3.Int("x")
+    with Session(x > 0) as session:
+        counts = [session.check(x < 5).statistics["rlimit count"] for _ in range(3)]
+    assert counts[0] == counts[1] == counts[2]
+
+def test_cache_disk_verdicts(tmp_path):
+    path = str(tmp_path / "cache")
+    enable_cache(path=path)
+    try:
+        assert solve(pigeons_in_holes(4, 3)) == SAT
+        assert prove(pigeonhole_principle_general(), timeout=100) == UNKNOWN
+        enable_cache(path=path)
+        # SAT from disk is enough for solve, but not for get_solution
+        assert solve(pigeons_in_holes(4, 3)) == SAT
+        assert cache_info()["hits"] == 1
+        assert get_solution(pigeons_in_holes(4, 3)) is not None
+        assert cache_info()["misses"] == 1
+        # UNKNOWN (here, a timeout) is not kept between runs
+        enable_cache(path=path)
+        assert prove(pigeonhole_principle_general(), timeout=100) == UNKNOWN
+        assert cache_info()["misses"] == 1
+    finally:
+        disable_cache()
+
+def test_pigeonhole_principle_strategies():
+    configs = [{"tactic": "smt", "params": {}}]
+    assert prove_pigeonhole(3000, "bounded", portfolio_prove, configs=configs) == PROVED
+    assert prove(pigeonhole_principle(3000), strategy=["simplify", "smt"]) == PROVED
+    assert prove(pigeonhole_principle(50, "pb"), strategy="cardinality") == PROVED
+    assert prove(pigeonhole_principle(10), strategy="smt", params={"random_seed": 1}) == PROVED
+    with pytest.raises(ValueError):
+        prove(pigeonhole_principle(10), session=Session(), strategy="pigeonhole")
+    # Presets and portfolio configurations are interchangeable
+    for config in DEFAULT_PORTFOLIO + list(STRATEGIES.values()):
+        spec = pigeonhole_principle(5, "pb" if config.get("logic") else "int")
+        assert prove(spec, strategy=config) == PROVED
+    result = portfolio_prove(pigeonhole_principle(5, "pb"), [STRATEGIES["cardinality"]])
+    assert result == PROVED and result.errors == []
+
+"""
+=== Bounded checking ===
+
+Z3 can't decide the general encoding, but it can check it for every
+fixed number of holes up to some bound: prove_bounded (see helper.py)
+substitutes n = 0, 1, 2, ... and unrolls the quantifiers over the
+holes into finite conjunctions and disjunctions.
+This proves the principle for all n up to the bound (not for all n),
+and finds concrete counterexamples to the false version.
+"""
+
+def test_pigeonhole_principle_bounded():
+    n = z3.Int("n")
+    results = list(prove_bounded(pigeonhole_principle_general(), n, 30))
+    assert [k for k, _ in results] == list(range(31))
+    assert all(result == PROVED for _, result in results)
+    results = list(prove_bounded(pigeonhole_principle_false(), n, 30))
+    k, result = results[-1]
+    assert result == COUNTEREXAMPLE
+    assert k == 0 and len(results) == 1
+    assert result.model is not None
+
+def test_prove_bounded_nested():
+    n, i, j = z3.Ints("n i j")
+    a = z3.Array("a", z3.IntSort(), z3.IntSort())
+    b = z3.Array("b", z3.IntSort(), z3.IntSort())
+    def index(v):
+        return z3.And(v >= 0, v < n)
+    # Every a[i] is some b[j]: false once a[1] is checked
+    spec = z3.Implies(
+        z3.And(a[0] == 5, a[1] == 7, b[0] == 5, b[1] == 5),
+        z3.ForAll(i, z3.Implies(index(i), z3.Exists(j, z3.And(index(j), a[i] == b[j])))),
+    )
+    results = list(prove_bounded(spec, n, 5))
+    assert [str(result) for _, result in results] == ["unsat", "unsat", "sat"]
+    # Each instance of the outer quantifier keeps its own index
+    unrolled = unroll(z3.ForAll(i, z3.Exists(j, a[i] == b[j] + i - j)), n, 2)
+    assert prove(unrolled == z3.And(
+        z3.Or(a[0] == b[0], a[0] == b[1] - 1),
+        z3.Or(a[1] == b[0] + 1, a[1] == b[1]),
+    )) == PROVED
+
 """
 8. Is the result what you expected?
 Why do you think Z3 has trouble with this problem?